@@ -0,0 +1,157 @@
+"""
+Server-Sent Events fan-out of new alerts
+One broadcaster thread per worker process looks for alerts newer than the
+last one it has seen and hands them to the queues of connected users, so the
+database sees one indexed query per interval per process however many
+browsers are listening. On PostgreSQL the birthday check NOTIFYs the
+channel after writing alerts and the broadcaster wakes up immediately;
+elsewhere it polls every ALERT_STREAM_POLL_SECONDS.
+"""
+from collections import defaultdict
+import json
+import logging
+import queue
+import select as select_module
+import threading
+import time
+
+from sqlalchemy import func, select, text
+
+from app_factory import db
+from models import Alert
+import metrics
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = 'birthday_alerts'
+
+
+def notify_new_alerts():
+    """Wake the broadcasters of all workers once the current transaction commits (PostgreSQL only)"""
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text('SELECT pg_notify(:channel, \'\')'), {'channel': NOTIFY_CHANNEL})
+
+
+def alert_event(alert):
+    """SSE message for one alert row"""
+    data = json.dumps({
+        'id': alert.id,
+        'friend_id': alert.friend_id,
+        'alert_type': alert.alert_type,
+        'message': alert.message,
+        'created_at': alert.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+        'is_read': alert.is_read
+    }, ensure_ascii=False)
+    return f'id: {alert.id}\nevent: alert\ndata: {data}\n\n'
+
+
+def alert_columns():
+    """Columns loaded for pushed alerts"""
+    return (Alert.id, Alert.user_id, Alert.friend_id, Alert.alert_type, Alert.message, Alert.created_at, Alert.is_read)
+
+
+class AlertBroadcaster:
+    """Delivers newly inserted alerts to per-connection queues in this process"""
+
+    def __init__(self, app):
+        self.app = app
+        self.poll_seconds = app.config['ALERT_STREAM_POLL_SECONDS']
+        self._subscribers = defaultdict(set)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._listener = None
+
+    def subscribe(self, user_id):
+        """Queue that receives the user's new alerts until unsubscribe()"""
+        events = queue.Queue(maxsize=100)
+        with self._lock:
+            self._subscribers[user_id].add(events)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='alert-broadcaster', daemon=True)
+                self._thread.start()
+        return events
+
+    def unsubscribe(self, user_id, events):
+        with self._lock:
+            self._subscribers[user_id].discard(events)
+            if not self._subscribers[user_id]:
+                del self._subscribers[user_id]
+
+    def _run(self):
+        with self.app.app_context():
+            last_id = None
+            while True:
+                try:
+                    with self._lock:
+                        listening = bool(self._subscribers)
+                    if not listening:
+                        # Nobody to deliver to; start from the newest alert when someone connects
+                        last_id = None
+                        time.sleep(self.poll_seconds)
+                        continue
+                    if last_id is None:
+                        last_id = db.session.scalar(select(func.coalesce(func.max(Alert.id), 0)))
+                        db.session.commit()
+                    self._wait()
+                    last_id = self._deliver(last_id)
+                except Exception as e:
+                    logger.error(f"Alert broadcaster error: {e}")
+                    db.session.rollback()
+                    self._close_listener()
+                    time.sleep(self.poll_seconds)
+
+    def _deliver(self, last_id):
+        """Hand alerts after ``last_id`` to their users' queues; returns the new last id"""
+        alerts = db.session.execute(
+            select(*alert_columns()).where(Alert.id > last_id).order_by(Alert.id).limit(1000)
+        ).all()
+        db.session.commit()
+        if not alerts:
+            return last_id
+
+        with self._lock:
+            targets = {user_id: list(queues) for user_id, queues in self._subscribers.items()}
+        for alert in alerts:
+            for events in targets.get(alert.user_id, ()):
+                try:
+                    events.put_nowait(alert)
+                except queue.Full:
+                    # A stalled client; it refetches the list when it reconnects
+                    pass
+        metrics.incr('alerts_pushed', len(alerts))
+        return alerts[-1].id
+
+    def _wait(self):
+        """Sleep until NOTIFY arrives (PostgreSQL) or the poll interval passes"""
+        if db.engine.dialect.name != 'postgresql':
+            time.sleep(self.poll_seconds)
+            return
+        if self._listener is None:
+            self._listener = db.engine.raw_connection()
+            self._listener.driver_connection.autocommit = True
+            self._listener.cursor().execute(f'LISTEN {NOTIFY_CHANNEL}')
+        conn = self._listener.driver_connection
+        if select_module.select([conn], [], [], self.poll_seconds)[0]:
+            conn.poll()
+            conn.notifies.clear()
+
+    def _close_listener(self):
+        if self._listener is not None:
+            try:
+                self._listener.invalidate()
+            except Exception:
+                pass
+            self._listener = None
+
+
+_broadcaster = None
+_broadcaster_lock = threading.Lock()
+
+
+def get_broadcaster(app):
+    """Return the process-wide broadcaster"""
+    global _broadcaster
+    with _broadcaster_lock:
+        if _broadcaster is None:
+            _broadcaster = AlertBroadcaster(app)
+        return _broadcaster
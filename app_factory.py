@@ -9,6 +9,7 @@ import logging
 from logging.handlers import RotatingFileHandler
 import os
 from dotenv import load_dotenv
+import ratelimit_storage  # registers the sqlite:// rate-limit storage
 
 load_dotenv()
 
@@ -42,6 +43,9 @@ def create_app(config_name='development'):
     login_manager.login_message = 'Please log in to access this page.'
     login_manager.login_message_category = 'info'
     
+    # Session users are loaded through the per-process user cache
+    import user_cache
+    
     # Setup logging
     setup_logging(app)
     
@@ -54,17 +58,34 @@ def create_app(config_name='development'):
     # Register error handlers
     register_error_handlers(app)
     
+    # Register CLI commands
+    register_commands(app)
+    
     # Create database tables
     with app.app_context():
+        if db.engine.dialect.name == 'sqlite':
+            apply_sqlite_pragmas(db.engine, app.config['SQLITE_PRAGMAS'])
         db.create_all()
     
     # Start background scheduler
-    if not app.config.get('TESTING'):
+    if not app.config.get('TESTING') and app.config['SCHEDULER_ENABLED']:
         start_scheduler(app)
     
     return app
 
 
+def apply_sqlite_pragmas(engine, pragmas):
+    """Run PRAGMA name=value for ``pragmas`` on every new connection of ``engine``"""
+    from sqlalchemy import event
+    
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+
 def setup_logging(app):
     """Configure application logging"""
     if not app.debug and not app.testing:
@@ -104,18 +125,77 @@ def register_error_handlers(app):
     @app.errorhandler(429)
     def ratelimit_handler(error):
         return {'error': 'Rate limit exceeded. Please try again later.'}, 429
+    
+    @app.errorhandler(503)
+    def unavailable_error(error):
+        return {'error': error.description}, 503
+
+
+def register_commands(app):
+    """Register flask CLI commands"""
+    import click
+    
+    @app.cli.command('check-birthdays')
+    @click.option('--shards', default=1, help='Split the check by user_id into this many shards')
+    @click.option('--processes', default=1, help='Worker processes claiming shards')
+    def check_birthdays_command(shards, processes):
+        """Run the birthday check now, optionally sharded across processes"""
+        from services import check_birthdays, seed_birthday_check
+        from models import BirthdayCheckShard
+        import multiprocessing
+        
+        if shards <= 1:
+            check_birthdays(app)
+            return
+        
+        run_key = seed_birthday_check(shards)
+        os.environ['SCHEDULER_ENABLED'] = 'false'
+        context = multiprocessing.get_context('spawn')
+        workers = [context.Process(target=run_shard_worker) for _ in range(processes)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        
+        db.session.expire_all()
+        for shard in BirthdayCheckShard.query.filter_by(run_key=run_key).order_by(BirthdayCheckShard.shard):
+            click.echo(f'Shard {shard.shard}/{shard.shards}: {shard.status}, {shard.processed} friends')
+
+
+def run_shard_worker():
+    """Entry point for a spawned shard worker process"""
+    from wsgi import app
+    from services import process_birthday_shards
+    process_birthday_shards(app)
 
 
 def start_scheduler(app):
-    """Start background scheduler for birthday checks"""
+    """Start background scheduler for birthday checks
+    
+    Every process runs the scheduler, but the birthday jobs only execute in
+    the process holding the cluster-wide scheduler lease; the heartbeat job
+    renews it, or takes it over once the previous leader stops renewing.
+    """
     from apscheduler.schedulers.background import BackgroundScheduler
-    from services import check_birthdays
+    from datetime import datetime
+    from services import (dispatch_outbox, pregenerate_birthday_messages, process_birthday_shards,
+                          prune_message_cache, prune_outbox, roll_next_birthdays, run_as_leader,
+                          scheduled_birthday_check, scheduler_heartbeat)
     
     scheduler = BackgroundScheduler()
     
+    # Renew or take over the scheduler lease
+    scheduler.add_job(
+        func=lambda: scheduler_heartbeat(app),
+        trigger="interval",
+        seconds=app.config['SCHEDULER_HEARTBEAT_SECONDS'],
+        next_run_time=datetime.now(),
+        id='scheduler_heartbeat'
+    )
+    
     # Check birthdays every hour
     scheduler.add_job(
-        func=lambda: check_birthdays(app),
+        func=lambda: run_as_leader(app, 'hourly_birthday_check', scheduled_birthday_check),
         trigger="interval",
         hours=1,
         id='hourly_birthday_check'
@@ -123,13 +203,67 @@ def start_scheduler(app):
     
     # Check at midnight daily
     scheduler.add_job(
-        func=lambda: check_birthdays(app),
+        func=lambda: run_as_leader(app, 'midnight_birthday_check', scheduled_birthday_check),
         trigger="cron",
         hour=0,
         minute=0,
         id='midnight_birthday_check'
     )
     
+    # Roll friends.next_birthday past today's birthdays; hourly (the roll is idempotent)
+    # so a leader that was down at midnight catches up instead of hiding friends for a day
+    scheduler.add_job(
+        func=lambda: run_as_leader(app, 'roll_next_birthdays', roll_next_birthdays),
+        trigger="cron",
+        minute=1,
+        coalesce=True,
+        misfire_grace_time=3600,
+        id='roll_next_birthdays'
+    )
+    
+    # Draft messages for the coming days while traffic is low
+    scheduler.add_job(
+        func=lambda: run_as_leader(app, 'pregenerate_birthday_messages', pregenerate_birthday_messages),
+        trigger="cron",
+        hour=app.config['PREGENERATE_HOUR'],
+        minute=0,
+        id='pregenerate_birthday_messages'
+    )
+    
+    # Expire and evict AI message cache entries
+    scheduler.add_job(
+        func=lambda: run_as_leader(app, 'prune_message_cache', prune_message_cache),
+        trigger="cron",
+        hour=4,
+        minute=30,
+        id='prune_message_cache'
+    )
+    
+    scheduler.add_job(
+        func=lambda: run_as_leader(app, 'prune_outbox', prune_outbox),
+        trigger="cron",
+        hour=4,
+        minute=45,
+        id='prune_outbox'
+    )
+    
+    # Every process helps with a sharded birthday check
+    if app.config['BIRTHDAY_CHECK_SHARDS'] > 1:
+        scheduler.add_job(
+            func=lambda: process_birthday_shards(app),
+            trigger="interval",
+            seconds=app.config['BIRTHDAY_SHARD_POLL_SECONDS'],
+            id='birthday_shard_worker'
+        )
+    
+    # Deliver queued emails (safe in every process, rows are leased)
+    scheduler.add_job(
+        func=lambda: dispatch_outbox(app),
+        trigger="interval",
+        seconds=app.config['OUTBOX_POLL_SECONDS'],
+        id='outbox_dispatch'
+    )
+    
     scheduler.start()
     app.logger.info('Background scheduler started')
     
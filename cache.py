@@ -0,0 +1,158 @@
+"""
+Per-user response cache and conditional GETs for read-only API endpoints
+Each user row carries a data_version stamp that every write affecting the
+user's dashboard bumps in the same transaction. Cached bodies are keyed by
+that version, so a write in any worker makes every worker's old entries
+unreachable; they simply age out of the bounded per-process LRU.
+"""
+from collections import OrderedDict
+from datetime import datetime
+from functools import wraps
+import hashlib
+import threading
+
+from flask import Response, current_app, g, request
+from flask_login import current_user
+
+from app_factory import db
+from models import User
+import metrics
+
+
+class LRUCache:
+    """Thread-safe mapping that evicts the least recently used entry past ``max_entries``"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+            except KeyError:
+                return None
+            return self._entries[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_responses = None
+_responses_lock = threading.Lock()
+
+
+def get_response_cache():
+    """Return the process-wide response cache sized from the app config"""
+    global _responses
+    with _responses_lock:
+        if _responses is None:
+            _responses = LRUCache(current_app.config['RESPONSE_CACHE_MAX_ENTRIES'])
+        return _responses
+
+
+def bump_data_version(*user_ids):
+    """Invalidate cached responses of these users (runs in the caller's transaction)"""
+    user_ids = sorted(set(user_ids))
+    if not user_ids:
+        return
+    User.query.filter(User.id.in_(user_ids)).update(
+        {User.data_version: db.func.coalesce(User.data_version, 0) + 1},
+        synchronize_session=False
+    )
+
+
+def current_data_version():
+    """The current user's data_version, read once per request
+
+    The session's user may be a cached snapshot (see user_cache.py), so the
+    stamp is always read from the database.
+    """
+    if 'data_version' not in g:
+        g.data_version = db.session.scalar(
+            db.select(User.data_version).where(User.id == current_user.id)
+        ) or 0
+    return g.data_version
+
+
+def conditional_response(validators):
+    """Answer If-None-Match GETs with 304 from cheap aggregates instead of the full body
+
+    ``validators(*args, **kwargs)`` returns a tuple (e.g. row count and max
+    timestamp) that changes whenever the response would; together with the
+    user's data_version it forms a strong ETag.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            parts = (
+                request.endpoint,
+                request.query_string,
+                current_user.id,
+                current_data_version(),
+                *validators(*args, **kwargs)
+            )
+            etag = hashlib.sha1(repr(parts).encode()).hexdigest()
+            if request.if_none_match.contains(etag):
+                metrics.incr('not_modified_responses')
+                response = Response(status=304)
+            else:
+                response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return decorator
+
+
+def cached_response(daily=False):
+    """Serve a login_required GET handler's 200 responses from the response cache
+
+    Entries are keyed by endpoint, user, the user's data_version and the query
+    string; ``daily`` adds today's date for responses computed relative to it.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not current_app.config['RESPONSE_CACHE_ENABLED']:
+                return view(*args, **kwargs)
+
+            key = (
+                request.endpoint,
+                current_user.id,
+                current_data_version(),
+                request.query_string,
+                datetime.now().date() if daily else None
+            )
+            cache = get_response_cache()
+            entry = cache.get(key)
+            if entry is not None:
+                metrics.incr('response_cache_hits')
+                body, headers = entry
+                return Response(body, headers=headers)
+
+            metrics.incr('response_cache_misses')
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                cache.set(key, (response.get_data(), list(response.headers.items())))
+            return response
+        return wrapper
+    return decorator
@@ -4,14 +4,58 @@ Configuration settings for Birthday Reminder App
 import os
 from datetime import timedelta
 
+
+def engine_options(database_uri):
+    """SQLALCHEMY_ENGINE_OPTIONS for the backend of ``database_uri``
+
+    SQLite is tuned per connection instead (SQLITE_PRAGMAS). Server databases
+    get a bounded, pre-pinged pool per process; PostgreSQL also gets a
+    statement timeout so a runaway query can't hold a worker forever.
+    """
+    if database_uri.startswith('sqlite'):
+        return {}
+    options = {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', 10)),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': True,
+    }
+    if database_uri.startswith('postgres'):
+        options['connect_args'] = {'options': f"-c statement_timeout={int(os.getenv('DB_STATEMENT_TIMEOUT_MS', 30000))}"}
+    return options
+
+
 class Config:
     """Base configuration"""
     SECRET_KEY = os.getenv('SECRET_KEY', 'dev-secret-key-change-in-production')
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL', 'sqlite:///birthdays.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI)
+    
+    # Set on every new SQLite connection: WAL lets API workers read while the scheduler writes,
+    # and writers wait up to busy_timeout ms for the lock instead of failing with "database is locked"
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+        'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+        'cache_size': -int(os.getenv('SQLITE_CACHE_KB', 64 * 1024)),  # negative = KiB, per connection
+    }
     
     # OpenAI
     OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+    # Per process: divide the provider limit by the number of processes generating messages
+    AI_MAX_CONCURRENCY = int(os.getenv('AI_MAX_CONCURRENCY', 8))
+    AI_REQUESTS_PER_MINUTE = int(os.getenv('AI_REQUESTS_PER_MINUTE', 500))
+    AI_MAX_RETRIES = int(os.getenv('AI_MAX_RETRIES', 3))
+    AI_REQUEST_TIMEOUT = float(os.getenv('AI_REQUEST_TIMEOUT', 30))
+    
+    # Shared AI message cache: variants kept per prompt, entry lifetime and size cap
+    AI_CACHE_ENABLED = os.getenv('AI_CACHE_ENABLED', 'true').lower() != 'false'
+    AI_CACHE_VARIANTS = int(os.getenv('AI_CACHE_VARIANTS', 5))
+    AI_CACHE_TTL_DAYS = int(os.getenv('AI_CACHE_TTL_DAYS', 90))
+    AI_CACHE_MAX_ENTRIES = int(os.getenv('AI_CACHE_MAX_ENTRIES', 100000))
     
     # Email Configuration
     SMTP_SERVER = os.getenv('SMTP_SERVER', 'smtp.gmail.com')
@@ -19,6 +63,70 @@ class Config:
     SMTP_EMAIL = os.getenv('SMTP_EMAIL')
     SMTP_PASSWORD = os.getenv('SMTP_PASSWORD')
     
+    # Email outbox dispatcher
+    OUTBOX_POLL_SECONDS = int(os.getenv('OUTBOX_POLL_SECONDS', 30))
+    OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 50))
+    OUTBOX_LEASE_SECONDS = int(os.getenv('OUTBOX_LEASE_SECONDS', 300))
+    OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 6))
+    OUTBOX_RETRY_BASE_SECONDS = int(os.getenv('OUTBOX_RETRY_BASE_SECONDS', 60))
+    OUTBOX_RETENTION_DAYS = int(os.getenv('OUTBOX_RETENTION_DAYS', 30))
+    
+    # Scheduler leader election (one process in the cluster runs the jobs)
+    SCHEDULER_LEASE_NAME = 'birthday-scheduler'
+    SCHEDULER_LEASE_SECONDS = int(os.getenv('SCHEDULER_LEASE_SECONDS', 60))
+    SCHEDULER_HEARTBEAT_SECONDS = int(os.getenv('SCHEDULER_HEARTBEAT_SECONDS', 15))
+    
+    # Birthday check: rows per bulk insert / commit
+    BIRTHDAY_CHECK_BATCH_SIZE = int(os.getenv('BIRTHDAY_CHECK_BATCH_SIZE', 500))
+    # Off-peak pre-generation of messages for birthdays in the next N days
+    PREGENERATE_DAYS = int(os.getenv('PREGENERATE_DAYS', 7))
+    PREGENERATE_HOUR = int(os.getenv('PREGENERATE_HOUR', 3))
+    # Split the check by user_id into this many shards processed by all workers
+    BIRTHDAY_CHECK_SHARDS = int(os.getenv('BIRTHDAY_CHECK_SHARDS', 1))
+    BIRTHDAY_SHARD_POLL_SECONDS = int(os.getenv('BIRTHDAY_SHARD_POLL_SECONDS', 10))
+    BIRTHDAY_SHARD_LEASE_SECONDS = int(os.getenv('BIRTHDAY_SHARD_LEASE_SECONDS', 300))
+    
+    # Per-process cache of dashboard API responses, invalidated through users.data_version
+    RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'true').lower() != 'false'
+    RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 5000))
+    
+    # Keyset pagination of list endpoints (?limit=...)
+    API_PAGE_SIZE = int(os.getenv('API_PAGE_SIZE', 50))
+    API_MAX_PAGE_SIZE = int(os.getenv('API_MAX_PAGE_SIZE', 500))
+    
+    # Bulk friend import: rows per INSERT batch and row errors listed in the report
+    IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', 1000))
+    IMPORT_MAX_ERRORS = int(os.getenv('IMPORT_MAX_ERRORS', 1000))
+    
+    # Rows fetched per server-side cursor batch when streaming an export
+    EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+    
+    # iCalendar feeds kept per process, and how long calendar clients may reuse a feed
+    CALENDAR_CACHE_MAX_ENTRIES = int(os.getenv('CALENDAR_CACHE_MAX_ENTRIES', 2000))
+    CALENDAR_MAX_AGE = int(os.getenv('CALENDAR_MAX_AGE', 900))
+    
+    # Server-Sent Events for new alerts (needs an async worker class, see gunicorn_config.py)
+    ALERT_STREAM_ENABLED = os.getenv('ALERT_STREAM_ENABLED', 'true').lower() != 'false'
+    ALERT_STREAM_POLL_SECONDS = float(os.getenv('ALERT_STREAM_POLL_SECONDS', 5))
+    ALERT_STREAM_HEARTBEAT_SECONDS = int(os.getenv('ALERT_STREAM_HEARTBEAT_SECONDS', 20))
+    ALERT_STREAM_MAX_SECONDS = int(os.getenv('ALERT_STREAM_MAX_SECONDS', 3600))
+    
+    # Per-process snapshots of logged-in users: lifetime, size cap and how often the cross-worker stamp is read
+    USER_CACHE_ENABLED = os.getenv('USER_CACHE_ENABLED', 'true').lower() != 'false'
+    USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 300))
+    USER_CACHE_MAX_ENTRIES = int(os.getenv('USER_CACHE_MAX_ENTRIES', 10000))
+    USER_CACHE_STAMP_SECONDS = float(os.getenv('USER_CACHE_STAMP_SECONDS', 5))
+    
+    # Password hashing: werkzeug method (e.g. scrypt:32768:8:1 or pbkdf2:sha256:600000), spawned helper
+    # processes per worker (0 hashes in the request thread), queued hashes and seconds before answering 503
+    PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+    PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', 2))
+    PASSWORD_HASH_MAX_PENDING = int(os.getenv('PASSWORD_HASH_MAX_PENDING', 16))
+    PASSWORD_HASH_TIMEOUT = float(os.getenv('PASSWORD_HASH_TIMEOUT', 5))
+    
+    # Set to false for one-off worker processes (e.g. flask check-birthdays)
+    SCHEDULER_ENABLED = os.getenv('SCHEDULER_ENABLED', 'true').lower() != 'false'
+    
     # Session Configuration
     PERMANENT_SESSION_LIFETIME = timedelta(days=7)
     SESSION_COOKIE_SECURE = False  # Set to True in production with HTTPS
@@ -31,7 +139,9 @@ class Config:
     
     # Rate Limiting
     RATELIMIT_ENABLED = True
-    RATELIMIT_STORAGE_URL = "memory://"
+    # Shared by all workers on the host (see ratelimit_storage.py); redis://... for several hosts
+    RATELIMIT_STORAGE_URI = os.getenv('RATELIMIT_STORAGE_URI', 'sqlite:///instance/ratelimits.db')
+    RATELIMIT_STRATEGY = os.getenv('RATELIMIT_STRATEGY', 'moving-window')
     RATELIMIT_DEFAULT = "200 per day, 50 per hour"
     
     # Logging
@@ -59,7 +169,10 @@ class TestingConfig(Config):
     """Testing configuration"""
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///test_birthdays.db'
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI)
     WTF_CSRF_ENABLED = False
+    PASSWORD_HASH_WORKERS = 0
+    RATELIMIT_STORAGE_URI = 'memory://'
 
 
 # Configuration dictionary
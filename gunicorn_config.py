@@ -1,6 +1,9 @@
+import os
+
 bind = "0.0.0.0:5000"
 workers = 4
-worker_class = "sync"
+# gevent lets each worker hold many idle /api/alerts/stream connections
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
 worker_connections = 1000
 timeout = 30
 keepalive = 2
@@ -16,3 +19,4 @@ proc_name = "birthday_reminder_app"
 # Server mechanics
 daemon = False
 pidfile = "logs/gunicorn.pid"
+
@@ -0,0 +1,112 @@
+"""
+iCalendar subscription feed of a user's friends' birthdays
+Feeds are rendered once per users.data_version and kept gzip-compressed in a
+bounded per-process LRU, so a poll that hits the cache costs one indexed
+lookup of the token and no ORM work.
+"""
+from datetime import datetime
+import gzip
+import hashlib
+import threading
+
+from flask import current_app
+from sqlalchemy import select
+
+from app_factory import db
+from cache import LRUCache
+from models import User, Friend
+
+
+def _escape(text):
+    """Escape a TEXT value (RFC 5545 3.3.11)"""
+    return (text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+            .replace('\r\n', '\\n').replace('\n', '\\n'))
+
+
+def _fold(line):
+    """Split a content line into 75-octet pieces (RFC 5545 3.1)"""
+    data = line.encode()
+    if len(data) <= 75:
+        return line
+    pieces = []
+    while data:
+        size = 75 if not pieces else 74
+        # Never split inside a multi-byte UTF-8 character
+        while size < len(data) and (data[size] & 0xC0) == 0x80:
+            size -= 1
+        pieces.append(data[:size].decode())
+        data = data[size:]
+    return '\r\n '.join(pieces)
+
+
+def render_calendar(friends, stamp=None):
+    """VCALENDAR text with one yearly-recurring all-day VEVENT per (id, name, birthday) row"""
+    stamp = (stamp or datetime.utcnow()).strftime('%Y%m%dT%H%M%SZ')
+    lines = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//Birthday Reminder App//EN',
+        'CALSCALE:GREGORIAN',
+        'METHOD:PUBLISH',
+        'X-WR-CALNAME:Birthdays',
+    ]
+    for friend in friends:
+        if friend.birthday.month == 2 and friend.birthday.day == 29:
+            # Last day of February, i.e. Feb 28 in non-leap years
+            rule = 'RRULE:FREQ=YEARLY;BYMONTH=2;BYMONTHDAY=-1'
+        else:
+            rule = 'RRULE:FREQ=YEARLY'
+        lines += [
+            'BEGIN:VEVENT',
+            f'UID:friend-{friend.id}@birthday-reminder',
+            f'DTSTAMP:{stamp}',
+            f"DTSTART;VALUE=DATE:{friend.birthday.strftime('%Y%m%d')}",
+            rule,
+            'SUMMARY:' + _escape(f"🎂 {friend.name}'s birthday"),
+            'TRANSP:TRANSPARENT',
+            'END:VEVENT',
+        ]
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(_fold(line) for line in lines) + '\r\n'
+
+
+_feeds = None
+_feeds_lock = threading.Lock()
+
+
+def _feed_cache():
+    """Return the process-wide feed cache sized from the app config"""
+    global _feeds
+    with _feeds_lock:
+        if _feeds is None:
+            _feeds = LRUCache(current_app.config['CALENDAR_CACHE_MAX_ENTRIES'])
+        return _feeds
+
+
+def calendar_feed(token):
+    """Cached (gzip body, ETag, Last-Modified) of the feed for ``token``, or None for unknown tokens"""
+    owner = db.session.execute(
+        select(User.id, User.data_version).where(User.calendar_token == token)
+    ).first()
+    if owner is None:
+        return None
+
+    version = owner.data_version or 0
+    cache = _feed_cache()
+    entry = cache.get(token)
+    if entry is not None and entry[0] == version:
+        return entry[1:]
+
+    friends = db.session.execute(
+        select(Friend.id, Friend.name, Friend.birthday)
+        .where(Friend.user_id == owner.id).order_by(Friend.id)
+    ).all()
+    etag = hashlib.sha1(repr([tuple(friend) for friend in friends]).encode()).hexdigest()
+    if entry is not None and entry[2] == etag:
+        # Something else in the user's data changed; the feed did not
+        feed = entry[1:]
+    else:
+        body = render_calendar(friends).encode()
+        feed = (gzip.compress(body), etag, datetime.utcnow().replace(microsecond=0))
+    cache.set(token, (version, *feed))
+    return feed
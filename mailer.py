@@ -0,0 +1,114 @@
+"""
+Pooled SMTP transport shared by all outgoing email
+"""
+from contextlib import contextmanager
+import logging
+import os
+import queue
+import smtplib
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class SMTPPool:
+    """Keeps up to ``size`` authenticated SMTP connections alive and reuses them
+
+    Each connection does STARTTLS and login once and then sends many
+    messages. A connection the server has dropped is replaced transparently
+    and the message is retried once on the fresh connection.
+    """
+
+    def __init__(self, host, port, username=None, password=None, size=4, timeout=30, use_tls=True):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.size = size
+        self.timeout = timeout
+        self.use_tls = use_tls
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+        """Open a new authenticated connection"""
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.use_tls:
+                server.starttls()
+            if self.username and self.password:
+                server.login(self.username, self.password)
+        except Exception:
+            self._discard(server)
+            raise
+        logger.info(f"Opened SMTP connection to {self.host}:{self.port}")
+        return server
+
+    @staticmethod
+    def _discard(server):
+        """Close a connection without caring whether the server is still there"""
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection; broken connections are not returned to the pool"""
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError("Timed out waiting for a free SMTP connection")
+        try:
+            try:
+                server = self._idle.get_nowait()
+            except queue.Empty:
+                server = self._connect()
+            try:
+                yield server
+            except Exception:
+                self._discard(server)
+                raise
+            self._idle.put(server)
+        finally:
+            self._slots.release()
+
+    def send(self, msg):
+        """Send one email.message.Message, reconnecting once if the server hung up"""
+        try:
+            with self.connection() as server:
+                server.send_message(msg)
+            return
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            # Idle connections are likely just as stale; drop them all
+            logger.info("SMTP connection was closed by the server, reconnecting")
+            self.close()
+        with self.connection() as server:
+            server.send_message(msg)
+
+    def close(self):
+        """Close all idle connections"""
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the process-wide SMTP pool configured from the environment"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SMTPPool(
+                host=os.getenv('SMTP_SERVER', 'smtp.gmail.com'),
+                port=int(os.getenv('SMTP_PORT', 587)),
+                username=os.getenv('SMTP_EMAIL'),
+                password=os.getenv('SMTP_PASSWORD'),
+                size=int(os.getenv('SMTP_POOL_SIZE', 4)),
+                timeout=float(os.getenv('SMTP_TIMEOUT', 30)),
+                use_tls=os.getenv('SMTP_USE_TLS', 'true').lower() != 'false'
+            )
+        return _pool
@@ -0,0 +1,27 @@
+"""
+In-process counters for operational metrics
+Counters are per worker process and reset on restart.
+"""
+from collections import Counter
+import threading
+
+_counters = Counter()
+_lock = threading.Lock()
+
+
+def incr(name, amount=1):
+    """Increase a counter"""
+    with _lock:
+        _counters[name] += amount
+
+
+def snapshot():
+    """Copy of all counters"""
+    with _lock:
+        return dict(_counters)
+
+
+def hit_rate(hits, misses):
+    """Fraction of lookups served from cache, or None before the first lookup"""
+    total = hits + misses
+    return round(hits / total, 4) if total else None
@@ -1,17 +1,42 @@
 """
 Database models for Birthday Reminder App
 """
-from app_factory import db, login_manager
+from app_factory import db
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import validates
+from datetime import datetime, date
+import calendar
+import secrets
 from itsdangerous import URLSafeTimedSerializer
 from flask import current_app
+from passwords import hash_password, verify_password
 
 
-@login_manager.user_loader
-def load_user(user_id):
-    return User.query.get(int(user_id))
+def birthday_keys(day):
+    """Return the (month, day) pairs whose birthdays are celebrated on ``day``.
+
+    Feb 29 birthdays are celebrated on Feb 28 in non-leap years.
+    """
+    keys = [(day.month, day.day)]
+    if day.month == 2 and day.day == 28 and not calendar.isleap(day.year):
+        keys.append((2, 29))
+    return keys
+
+
+def celebration_date(birthday, year):
+    """Date a birthday is celebrated in ``year`` (Feb 29 -> Feb 28 in non-leap years)"""
+    if birthday.month == 2 and birthday.day == 29 and not calendar.isleap(year):
+        return birthday.replace(year=year, day=28)
+    return birthday.replace(year=year)
+
+
+def next_occurrence(birthday, today):
+    """Next date, today or later, on which the birthday is celebrated"""
+    upcoming = celebration_date(birthday, today.year)
+    if upcoming < today:
+        upcoming = celebration_date(birthday, today.year + 1)
+    return upcoming
 
 
 class User(UserMixin, db.Model):
@@ -24,17 +49,27 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(255), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     is_active = db.Column(db.Boolean, default=True)
+    data_version = db.Column(db.Integer, nullable=False, default=0)  # bumped on every dashboard write
+    calendar_token = db.Column(db.String(64), unique=True, index=True)  # secret part of the iCalendar feed URL
     
     # Relationships
     friends = db.relationship('Friend', backref='user', lazy='dynamic', cascade='all, delete-orphan')
     
     def set_password(self, password):
         """Hash and set password"""
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
     
     def check_password(self, password):
-        """Check if password matches"""
-        return check_password_hash(self.password_hash, password)
+        """Check if password matches, upgrading a hash with outdated parameters (caller commits)"""
+        matches, new_hash = verify_password(self.password_hash, password)
+        if new_hash:
+            self.password_hash = new_hash
+        return matches
+    
+    def new_calendar_token(self):
+        """Issue a new calendar feed token, revoking the old feed URL"""
+        self.calendar_token = secrets.token_urlsafe(32)
+        return self.calendar_token
     
     def get_reset_token(self, expires_sec=1800):
         """Generate a password reset token (valid for 30 minutes)"""
@@ -63,6 +98,9 @@ class Friend(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
     name = db.Column(db.String(100), nullable=False)
     birthday = db.Column(db.Date, nullable=False, index=True)
+    birth_month = db.Column(db.SmallInteger)
+    birth_day = db.Column(db.SmallInteger)
+    next_birthday = db.Column(db.Date, index=True)  # rolled forward hourly (roll_next_birthdays)
     email = db.Column(db.String(120))
     phone = db.Column(db.String(20))
     relationship = db.Column(db.String(50))
@@ -73,6 +111,38 @@ class Friend(db.Model):
     # Relationships
     messages = db.relationship('BirthdayMessage', backref='friend', lazy='dynamic', cascade='all, delete-orphan')
     alerts = db.relationship('Alert', backref='friend', lazy='dynamic', cascade='all, delete-orphan')
+    drafts = db.relationship('MessageDraft', backref='friend', lazy='dynamic', cascade='all, delete-orphan')
+    
+    __table_args__ = (
+        db.Index('ix_friends_birth_month_day', 'birth_month', 'birth_day'),
+        db.Index('ix_friends_user_next_birthday', 'user_id', 'next_birthday'),
+        db.Index('ix_friends_user_name_id', 'user_id', 'name', 'id'),
+    )
+    
+    @staticmethod
+    def derived_fields(birthday, today=None):
+        """Indexed columns computed from the birthday"""
+        return {
+            'birth_month': birthday.month,
+            'birth_day': birthday.day,
+            'next_birthday': next_occurrence(birthday, today or date.today())
+        }
+    
+    @validates('birthday')
+    def _sync_birthday_fields(self, key, birthday):
+        """Keep the indexed month/day key and next occurrence in step with the birthday"""
+        for name, value in self.derived_fields(birthday).items():
+            setattr(self, name, value)
+        return birthday
+    
+    @classmethod
+    def celebrating_on(cls, *days):
+        """Query friends whose birthday falls on any of the given dates"""
+        keys = {key for day in days for key in birthday_keys(day)}
+        return cls.query.filter(or_(*[
+            and_(cls.birth_month == month, cls.birth_day == day)
+            for month, day in sorted(keys)
+        ]))
     
     def __repr__(self):
         return f'<Friend {self.name}>'
@@ -84,11 +154,18 @@ class BirthdayMessage(db.Model):
     
     id = db.Column(db.Integer, primary_key=True)
     friend_id = db.Column(db.Integer, db.ForeignKey('friends.id'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)  # copy of friend.user_id
     message = db.Column(db.Text, nullable=False)
     sent_at = db.Column(db.DateTime, default=datetime.utcnow)
     year = db.Column(db.Integer, nullable=False, index=True)
     email_sent = db.Column(db.Boolean, default=False)
     
+    __table_args__ = (
+        db.Index('ix_birthday_messages_friend_sent_id', 'friend_id', 'sent_at', 'id'),
+        # One message per friend per year, however many birthday checks overlap
+        db.Index('uq_birthday_messages_friend_year', 'friend_id', 'year', unique=True),
+    )
+    
     def __repr__(self):
         return f'<BirthdayMessage for Friend {self.friend_id}>'
 
@@ -99,6 +176,7 @@ class Alert(db.Model):
     
     id = db.Column(db.Integer, primary_key=True)
     friend_id = db.Column(db.Integer, db.ForeignKey('friends.id'), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)  # copy of friend.user_id
     alert_type = db.Column(db.String(20), nullable=False, index=True)  # 'reminder' or 'birthday'
     message = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
@@ -106,3 +184,120 @@ class Alert(db.Model):
     
     def __repr__(self):
         return f'<Alert {self.alert_type} for Friend {self.friend_id}>'
+
+
+# Alerts feed (keyset on created_at, id) and unread lookups, both within one user
+db.Index('ix_alerts_user_created_id', Alert.user_id, Alert.created_at, Alert.id)
+db.Index('ix_alerts_user_read_created', Alert.user_id, Alert.is_read, Alert.created_at.desc())
+
+
+class OutboxEmail(db.Model):
+    """Outgoing email waiting to be delivered by the outbox dispatcher"""
+    __tablename__ = 'outbox'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    to_email = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(255), nullable=False)
+    html = db.Column(db.Text, nullable=False)
+    birthday_message_id = db.Column(db.Integer, db.ForeignKey('birthday_messages.id', ondelete='SET NULL'), index=True)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # 'pending', 'sent' or 'failed'
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_by = db.Column(db.String(100), index=True)
+    locked_until = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+    
+    __table_args__ = (
+        db.Index('ix_outbox_status_next_attempt', 'status', 'next_attempt_at'),
+    )
+    
+    def __repr__(self):
+        return f'<OutboxEmail {self.status} to {self.to_email}>'
+
+
+class CacheStamp(db.Model):
+    """Cluster-wide version counter that per-process caches poll to notice writes in other workers"""
+    __tablename__ = 'cache_stamps'
+    
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<CacheStamp {self.name} v{self.version}>'
+
+
+class SchedulerLease(db.Model):
+    """Cluster-wide lease naming the one process that runs scheduled jobs"""
+    __tablename__ = 'scheduler_leases'
+    
+    name = db.Column(db.String(50), primary_key=True)
+    holder = db.Column(db.String(100))
+    expires_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)
+    last_run_job = db.Column(db.String(50))
+    last_run_at = db.Column(db.DateTime)
+    last_run_status = db.Column(db.String(255))
+    
+    def __repr__(self):
+        return f'<SchedulerLease {self.name} held by {self.holder}>'
+
+
+class BirthdayCheckShard(db.Model):
+    """Progress of one shard of a partitioned birthday check run"""
+    __tablename__ = 'birthday_check_shards'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    run_key = db.Column(db.String(32), nullable=False)
+    run_date = db.Column(db.Date, nullable=False)
+    shard = db.Column(db.Integer, nullable=False)
+    shards = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # 'pending', 'running' or 'done'
+    claimed_by = db.Column(db.String(100))
+    lease_until = db.Column(db.DateTime)
+    last_friend_id = db.Column(db.Integer, nullable=False, default=0)
+    processed = db.Column(db.Integer, nullable=False, default=0)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    
+    __table_args__ = (
+        db.UniqueConstraint('run_key', 'shard', name='uq_birthday_check_shards_run_shard'),
+        db.Index('ix_birthday_check_shards_run_date_status', 'run_date', 'status'),
+    )
+    
+    def __repr__(self):
+        return f'<BirthdayCheckShard {self.run_key} {self.shard}/{self.shards} {self.status}>'
+
+
+class AIMessageCache(db.Model):
+    """Generated birthday message, shared by every request with the same prompt"""
+    __tablename__ = 'ai_message_cache'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    cache_key = db.Column(db.String(64), nullable=False, index=True)  # sha256 of prompt, model and parameters
+    message = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    use_count = db.Column(db.Integer, nullable=False, default=1)
+    
+    def __repr__(self):
+        return f'<AIMessageCache {self.cache_key[:12]}>'
+
+
+class MessageDraft(db.Model):
+    """Birthday message generated ahead of time, sent on the birthday"""
+    __tablename__ = 'message_drafts'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    friend_id = db.Column(db.Integer, db.ForeignKey('friends.id'), nullable=False)
+    year = db.Column(db.Integer, nullable=False)
+    message = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.UniqueConstraint('friend_id', 'year', name='uq_message_drafts_friend_year'),
+    )
+    
+    def __repr__(self):
+        return f'<MessageDraft for Friend {self.friend_id} ({self.year})>'
@@ -0,0 +1,98 @@
+"""
+Password hashing off the web worker
+Hashes are computed in a small per-process pool of spawned helper processes,
+so a burst of logins queues there (and times out) instead of tying up every
+web worker. Outside requests (CLI, scripts) hashing runs inline. Stored
+hashes made with other parameters than PASSWORD_HASH_METHOD are replaced on
+the next successful login.
+"""
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+import multiprocessing
+import secrets
+import threading
+
+from flask import current_app, has_request_context
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import check_password_hash, generate_password_hash
+
+_pool = None
+_pending = None
+_dummy_hash = None
+_lock = threading.Lock()
+
+
+class PasswordHashTimeout(ServiceUnavailable):
+    """Hashing pool saturated; answered with 503"""
+    description = 'Too many sign-ins right now, please try again in a moment.'
+
+
+def _hash_pool():
+    """Return the process-wide hashing pool, or None to hash inline"""
+    global _pool, _pending
+    workers = current_app.config['PASSWORD_HASH_WORKERS']
+    if not workers or not has_request_context():
+        return None
+    with _lock:
+        if _pool is None:
+            # spawn: forking a threaded (or gevent) worker is unsafe
+            _pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+            _pending = threading.BoundedSemaphore(current_app.config['PASSWORD_HASH_MAX_PENDING'])
+        return _pool
+
+
+def _run(func, *args):
+    """func(*args) in the hashing pool, bounded by PASSWORD_HASH_MAX_PENDING and PASSWORD_HASH_TIMEOUT"""
+    pool = _hash_pool()
+    if pool is None:
+        return func(*args)
+    timeout = current_app.config['PASSWORD_HASH_TIMEOUT']
+    if not _pending.acquire(timeout=timeout):
+        raise PasswordHashTimeout()
+    try:
+        future = pool.submit(func, *args)
+    except BaseException:
+        _pending.release()
+        raise
+    # The slot is held until the hash is really done (or cancelled), not just until we stop waiting
+    future.add_done_callback(lambda _: _pending.release())
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeout:
+        future.cancel()
+        raise PasswordHashTimeout()
+
+
+def hash_password(password):
+    """Hash with the configured PASSWORD_HASH_METHOD"""
+    return _run(generate_password_hash, password, current_app.config['PASSWORD_HASH_METHOD'])
+
+
+def _dummy():
+    """Hash of a random password made with the current method (what unknown users are checked against)"""
+    global _dummy_hash
+    if _dummy_hash is None:
+        _dummy_hash = _run(generate_password_hash, secrets.token_urlsafe(16), current_app.config['PASSWORD_HASH_METHOD'])
+    return _dummy_hash
+
+
+def needs_rehash(stored_hash):
+    """True if ``stored_hash`` was made with other parameters than the configured method"""
+    return stored_hash.split('$', 1)[0] != _dummy().split('$', 1)[0]
+
+
+def verify_password(stored_hash, password):
+    """(matches, new_hash); new_hash is set when a match used outdated parameters"""
+    if not stored_hash or not password:
+        return False, None
+    if not _run(check_password_hash, stored_hash, password):
+        return False, None
+    if needs_rehash(stored_hash):
+        return True, hash_password(password)
+    return True, None
+
+
+def reject_unknown_user(password):
+    """Spend one verification on the dummy hash so unknown usernames take as long as known ones"""
+    if password:
+        _run(check_password_hash, _dummy(), password)
+    return False
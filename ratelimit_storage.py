@@ -0,0 +1,153 @@
+"""
+Host-wide rate-limit storage in a local SQLite file
+Flask-Limiter's memory:// storage counts per worker process, so every limit
+was as many times looser as there are gunicorn workers and reset whenever a
+worker restarted. This backend keeps counters and moving-window entries in
+one SQLite database in WAL mode shared by all workers on the host. A check
+is one short transaction that is not fsynced, and expired rows are purged
+in batches every PURGE_SECONDS instead of on each request.
+
+    RATELIMIT_STORAGE_URI=sqlite:///instance/ratelimits.db   (relative to the working directory)
+    RATELIMIT_STORAGE_URI=sqlite:////var/lib/birthdays/ratelimits.db
+"""
+from contextlib import contextmanager
+import os
+import sqlite3
+import threading
+import time
+
+from limits.storage import MovingWindowSupport, Storage
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS ratelimit_counters '
+    '(key TEXT PRIMARY KEY, value INTEGER NOT NULL, expires_at REAL NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS ratelimit_entries (key TEXT NOT NULL, at REAL NOT NULL, expires_at REAL NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS ix_ratelimit_entries_key_at ON ratelimit_entries (key, at)',
+    'CREATE INDEX IF NOT EXISTS ix_ratelimit_entries_expires_at ON ratelimit_entries (expires_at)',
+)
+
+
+class SQLiteStorage(Storage, MovingWindowSupport):
+    """Fixed- and moving-window rate-limit storage for the ``sqlite://`` scheme"""
+
+    STORAGE_SCHEME = ['sqlite']
+    PURGE_SECONDS = 60
+
+    def __init__(self, uri, wrap_exceptions=False, **options):
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        path = uri.split('://', 1)[1]
+        # sqlite:///relative.db or sqlite:////absolute.db, as in SQLAlchemy URLs
+        self.path = path[1:] if path.startswith('/') else path
+        self.timeout = float(options.get('timeout', 5))
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._purged_at = 0.0
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def _connection(self):
+        """The process's connection (reopened after a fork); call with the lock held"""
+        if self._conn is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # WAL + NORMAL: commits skip fsync; a power loss can only forget recent hits
+            conn.execute('PRAGMA synchronous=NORMAL')
+            for statement in SCHEMA:
+                conn.execute(statement)
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    @contextmanager
+    def _transaction(self):
+        """Write transaction that holds the database lock from the start"""
+        with self._lock:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._connection().execute(sql, params).fetchone()
+
+    def _purge(self, conn, now):
+        """Delete expired rows every PURGE_SECONDS; runs inside a write transaction"""
+        if now - self._purged_at < self.PURGE_SECONDS:
+            return
+        self._purged_at = now
+        conn.execute('DELETE FROM ratelimit_entries WHERE expires_at <= ?', (now,))
+        conn.execute('DELETE FROM ratelimit_counters WHERE expires_at <= ?', (now,))
+
+    def incr(self, key, expiry, amount=1):
+        now = time.time()
+        with self._transaction() as conn:
+            self._purge(conn, now)
+            # SET expressions see the row as it was before the update
+            return conn.execute(
+                'INSERT INTO ratelimit_counters (key, value, expires_at) VALUES (?, ?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET '
+                'value = CASE WHEN expires_at <= ? THEN excluded.value ELSE value + excluded.value END, '
+                'expires_at = CASE WHEN expires_at <= ? THEN excluded.expires_at ELSE expires_at END '
+                'RETURNING value',
+                (key, amount, now + expiry, now, now)
+            ).fetchone()[0]
+
+    def get(self, key):
+        row = self._query('SELECT value FROM ratelimit_counters WHERE key = ? AND expires_at > ?', (key, time.time()))
+        return row[0] if row else 0
+
+    def get_expiry(self, key):
+        now = time.time()
+        row = self._query('SELECT expires_at FROM ratelimit_counters WHERE key = ? AND expires_at > ?', (key, now))
+        return row[0] if row else now
+
+    def acquire_entry(self, key, limit, expiry, amount=1):
+        if amount > limit:
+            return False
+        now = time.time()
+        with self._transaction() as conn:
+            self._purge(conn, now)
+            taken = conn.execute(
+                'SELECT count(*) FROM ratelimit_entries WHERE key = ? AND at >= ?', (key, now - expiry)
+            ).fetchone()[0]
+            if taken + amount > limit:
+                return False
+            conn.executemany(
+                'INSERT INTO ratelimit_entries (key, at, expires_at) VALUES (?, ?, ?)',
+                [(key, now, now + expiry)] * amount
+            )
+            return True
+
+    def get_moving_window(self, key, limit, expiry):
+        now = time.time()
+        start, taken = self._query(
+            'SELECT min(at), count(*) FROM ratelimit_entries WHERE key = ? AND at >= ?', (key, now - expiry)
+        )
+        return (start, taken) if taken else (now, 0)
+
+    def clear(self, key):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM ratelimit_counters WHERE key = ?', (key,))
+            conn.execute('DELETE FROM ratelimit_entries WHERE key = ?', (key,))
+
+    def reset(self):
+        with self._transaction() as conn:
+            return (conn.execute('DELETE FROM ratelimit_counters').rowcount
+                    + conn.execute('DELETE FROM ratelimit_entries').rowcount)
+
+    def check(self):
+        try:
+            self._query('SELECT 1')
+            return True
+        except sqlite3.Error:
+            return False
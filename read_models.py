@@ -0,0 +1,138 @@
+"""
+Read models for the list endpoints
+Column-selected Core queries return plain Row tuples, so listing friends,
+alerts or messages builds no ORM objects and touches no identity map. Dates
+are formatted a column at a time and the JSON is encoded without the key
+sorting and pretty-printing jsonify applies.
+"""
+import base64
+import binascii
+from datetime import date, datetime, timedelta
+import json
+
+from flask import Response, current_app
+from sqlalchemy import select, tuple_
+
+from app_factory import db
+from models import Friend, Alert, BirthdayMessage
+
+FRIEND_COLUMNS = (Friend.id, Friend.name, Friend.birthday, Friend.email, Friend.phone, Friend.relationship, Friend.notes)
+ALERT_COLUMNS = (Alert.id, Alert.friend_id, Alert.alert_type, Alert.message, Alert.created_at, Alert.is_read)
+MESSAGE_COLUMNS = (BirthdayMessage.id, BirthdayMessage.message, BirthdayMessage.sent_at,
+                   BirthdayMessage.year, BirthdayMessage.email_sent)
+
+
+def encode_cursor(*values):
+    """Opaque cursor for the sort key of the last row on a page"""
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, *types):
+    """Sort key from a cursor, converting each value with ``types``; raises ValueError"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != len(types):
+        raise ValueError('Invalid cursor')
+    try:
+        return tuple(convert(value) for convert, value in zip(types, values))
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor')
+
+
+def keyset_page(stmt, columns, types, cursor=None, limit=None, descending=False):
+    """One page of the select ``stmt`` ordered by ``columns`` after ``cursor``
+
+    Returns (rows, next_cursor); next_cursor is None on the last page.
+    """
+    limit = limit or current_app.config['API_PAGE_SIZE']
+    key = tuple_(*columns)
+    if cursor:
+        after = decode_cursor(cursor, *types)
+        stmt = stmt.where(key < after if descending else key > after)
+    order = [column.desc() for column in columns] if descending else columns
+    rows = db.session.execute(stmt.order_by(*order).limit(limit + 1)).all()
+    if len(rows) <= limit:
+        return rows, None
+    last = rows[limit - 1]
+    return rows[:limit], encode_cursor(*(getattr(last, column.key) for column in columns))
+
+
+def format_dates(column):
+    """Format a column of dates/datetimes ('%Y-%m-%d' / '%Y-%m-%d %H:%M:%S'); None stays None"""
+    sample = next((value for value in column if value is not None), None)
+    if isinstance(sample, datetime):
+        return [value.isoformat(' ', 'seconds') if value is not None else None for value in column]
+    if isinstance(sample, date):
+        return [value.isoformat() if value is not None else None for value in column]
+    return list(column)
+
+
+def to_dicts(rows, keys, date_keys=()):
+    """Rows as dicts, with ``date_keys`` columns formatted in one pass per column"""
+    if not rows:
+        return []
+    columns = list(zip(*rows))
+    for index, key in enumerate(keys):
+        if key in date_keys:
+            columns[index] = format_dates(columns[index])
+    return [dict(zip(keys, values)) for values in zip(*columns)]
+
+
+def json_response(payload, headers=None):
+    """Compact JSON response (no key sorting or indentation)"""
+    body = json.dumps(payload, ensure_ascii=False, separators=(',', ':'))
+    return Response(body, mimetype='application/json', headers=headers)
+
+
+def friend(user_id, friend_id):
+    """One friend as a dict, or None"""
+    row = db.session.execute(
+        select(*FRIEND_COLUMNS).where(Friend.id == friend_id, Friend.user_id == user_id)
+    ).first()
+    return to_dicts([row], [c.key for c in FRIEND_COLUMNS], ('birthday',))[0] if row else None
+
+
+def friends_page(user_id, cursor=None, limit=None):
+    """A page of the user's friends ordered by name, and the next cursor"""
+    rows, next_cursor = keyset_page(
+        select(*FRIEND_COLUMNS).where(Friend.user_id == user_id),
+        [Friend.name, Friend.id], [str, int], cursor, limit
+    )
+    return to_dicts(rows, [c.key for c in FRIEND_COLUMNS], ('birthday',)), next_cursor
+
+
+def alerts_page(user_id, cursor=None, limit=None):
+    """A page of the user's alerts, newest first, and the next cursor"""
+    rows, next_cursor = keyset_page(
+        select(*ALERT_COLUMNS).where(Alert.user_id == user_id),
+        [Alert.created_at, Alert.id], [datetime.fromisoformat, int], cursor, limit, descending=True
+    )
+    return to_dicts(rows, [c.key for c in ALERT_COLUMNS], ('created_at',)), next_cursor
+
+
+def messages_page(user_id, friend_id, cursor=None, limit=None):
+    """A page of one friend's birthday messages, newest first, and the next cursor"""
+    rows, next_cursor = keyset_page(
+        select(*MESSAGE_COLUMNS).where(BirthdayMessage.friend_id == friend_id, BirthdayMessage.user_id == user_id),
+        [BirthdayMessage.sent_at, BirthdayMessage.id], [datetime.fromisoformat, int], cursor, limit, descending=True
+    )
+    return to_dicts(rows, [c.key for c in MESSAGE_COLUMNS], ('sent_at',)), next_cursor
+
+
+def upcoming_birthdays(user_id, today, days=30, limit=100):
+    """The user's birthdays in the next ``days`` days, soonest first"""
+    rows = db.session.execute(
+        select(Friend.id, Friend.name, Friend.next_birthday).where(
+            Friend.user_id == user_id,
+            Friend.next_birthday.between(today, today + timedelta(days=days))
+        ).order_by(Friend.next_birthday, Friend.id).limit(limit)
+    ).all()
+    return [{
+        'id': row.id,
+        'name': row.name,
+        'birthday': row.next_birthday.isoformat(),
+        'days_until': (row.next_birthday - today).days
+    } for row in rows]
@@ -1,13 +1,25 @@
 """
 Flask routes and blueprints
 """
-from flask import Blueprint, render_template, request, jsonify, redirect, url_for, flash
+from flask import (Blueprint, Response, render_template, request, jsonify, redirect, url_for, flash, current_app,
+                   stream_with_context, abort)
 from flask_login import login_required, current_user, login_user, logout_user
+from flask_limiter.util import get_remote_address
 from app_factory import db, limiter, csrf
-from models import User, Friend, BirthdayMessage, Alert
-from services import generate_birthday_message
+from models import User, Friend, BirthdayMessage, Alert, SchedulerLease, BirthdayCheckShard, MessageDraft
+from services import (EXPORT_COLUMNS, export_rows, generate_birthday_message, import_friend_rows, parse_friend_rows,
+                      stream_csv, stream_ndjson, stream_zip)
+from passwords import reject_unknown_user
+from cache import bump_data_version, cached_response, conditional_response
+from ical import calendar_feed
+from alert_stream import alert_columns, alert_event, get_broadcaster
+import read_models
 from datetime import datetime, timedelta
+import gzip
+import io
 import logging
+import queue
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -31,6 +43,34 @@ def index():
     return render_template('index.html')
 
 
+@main_bp.route('/cal/<token>.ics')
+# Per feed, since calendar services poll many users' feeds from a few shared addresses;
+# only tokens that resolve get a bucket, and a looser per-IP limit caps token guessing
+@limiter.limit("60 per hour", key_func=lambda: request.view_args['token'],
+               deduct_when=lambda response: response.status_code != 404)
+@limiter.limit("600 per hour", key_func=get_remote_address)
+def calendar_subscription(token):
+    """Birthdays as an iCalendar feed for calendar apps (no login; the token is the secret)"""
+    feed = calendar_feed(token)
+    if feed is None:
+        abort(404)
+    body, etag, last_modified = feed
+    
+    if 'gzip' in request.accept_encodings:
+        response = Response(body, mimetype='text/calendar')
+        response.headers['Content-Encoding'] = 'gzip'
+        # A strong ETag names exact bytes, so each encoding gets its own
+        etag += '-gzip'
+    else:
+        response = Response(gzip.decompress(body), mimetype='text/calendar')
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.max_age = current_app.config['CALENDAR_MAX_AGE']
+    return response.make_conditional(request)
+
+
 # ============= Authentication Routes =============
 
 @auth_bp.route('/login', methods=['GET', 'POST'])
@@ -49,7 +89,10 @@ def login():
         
         logger.info(f"Login attempt - Username: '{username}', Password length: {len(password) if password else 0}, User found: {user is not None}")
         
-        if user and user.check_password(password):
+        authenticated = user.check_password(password) if user else reject_unknown_user(password)
+        if authenticated:
+            # Persists a rehashed password
+            db.session.commit()
             login_user(user, remember=True)
             logger.info(f"User {username} logged in successfully")
             
@@ -58,7 +101,7 @@ def login():
             return redirect(url_for('main.index'))
         
         error_msg = 'Invalid username or password'
-        logger.warning(f"Failed login attempt for username: '{username}' - Password check: {user.check_password(password) if user else 'No user found'}")
+        logger.warning(f"Failed login attempt for username: '{username}' - {'wrong password' if user else 'No user found'}")
         
         if request.is_json:
             return jsonify({'success': False, 'error': error_msg}), 401
@@ -141,13 +184,11 @@ def forgot_password():
         
         if user:
             token = user.get_reset_token()
-            from services import send_password_reset_email
-            if send_password_reset_email(user, token):
-                flash('A password reset link has been sent to your email.', 'success')
-                logger.info(f"Password reset email sent to {email}")
-            else:
-                flash('Error sending email. Please try again later.', 'error')
-                logger.error(f"Failed to send password reset email to {email}")
+            from services import queue_password_reset_email
+            queue_password_reset_email(user, token)
+            db.session.commit()
+            flash('A password reset link has been sent to your email.', 'success')
+            logger.info(f"Password reset email queued for {email}")
         else:
             # Don't reveal if email exists or not for security
             flash('If that email is registered, a password reset link will be sent.', 'info')
@@ -193,21 +234,75 @@ def reset_password(token):
 
 # ============= API Routes =============
 
+def _page_args():
+    """(cursor, limit) requested in the query string"""
+    limit = request.args.get('limit', current_app.config['API_PAGE_SIZE'], type=int)
+    return request.args.get('cursor'), max(1, min(limit, current_app.config['API_MAX_PAGE_SIZE']))
+
+
+def _paged_response(items, next_cursor):
+    """JSON list with the next page's cursor in X-Next-Cursor"""
+    return read_models.json_response(items, headers={'X-Next-Cursor': next_cursor} if next_cursor else None)
+
+
+def _bad_cursor(e):
+    return jsonify({'error': str(e)}), 400
+
+
+def _friends_version():
+    """Count and latest change of the current user's friends"""
+    return db.session.query(
+        db.func.count(Friend.id), db.func.max(Friend.updated_at)
+    ).filter(Friend.user_id == current_user.id).one()
+
+
+def _alerts_version():
+    """Count, newest and read count of the current user's alerts"""
+    return db.session.query(
+        db.func.count(Alert.id), db.func.max(Alert.id), db.func.count(Alert.id).filter(Alert.is_read)
+    ).filter(Alert.user_id == current_user.id).one()
+
+
+def _upcoming_version():
+    """Friends version for today's date"""
+    return (*_friends_version(), datetime.now().date())
+
+
+def _dashboard_version():
+    """Friends and alerts versions for today's date"""
+    return (*_friends_version(), *_alerts_version(), datetime.now().date())
+
+
+def _messages_version(friend_id):
+    """Count, newest and emailed count of one of the current user's friends' messages"""
+    return db.session.query(
+        db.func.count(BirthdayMessage.id), db.func.max(BirthdayMessage.id),
+        db.func.count(BirthdayMessage.id).filter(BirthdayMessage.email_sent)
+    ).filter(BirthdayMessage.friend_id == friend_id, BirthdayMessage.user_id == current_user.id).one()
+
+
 @api_bp.route('/friends', methods=['GET'])
 @login_required
 @limiter.limit("100 per hour")
+@conditional_response(_friends_version)
+@cached_response()
 def get_friends():
-    """Get all friends for current user"""
-    friends = current_user.friends.order_by(Friend.name).all()
-    return jsonify([{
-        'id': f.id,
-        'name': f.name,
-        'birthday': f.birthday.strftime('%Y-%m-%d'),
-        'email': f.email,
-        'phone': f.phone,
-        'relationship': f.relationship,
-        'notes': f.notes
-    } for f in friends])
+    """Get a page of the current user's friends, ordered by name"""
+    try:
+        return _paged_response(*read_models.friends_page(current_user.id, *_page_args()))
+    except ValueError as e:
+        return _bad_cursor(e)
+
+
+@api_bp.route('/friends/<int:friend_id>', methods=['GET'])
+@login_required
+@limiter.limit("300 per hour")
+def get_friend(friend_id):
+    """Get one of the current user's friends"""
+    friend = read_models.friend(current_user.id, friend_id)
+    if friend is None:
+        abort(404)
+    return read_models.json_response(friend)
 
 
 @api_bp.route('/friends', methods=['POST'])
@@ -228,6 +323,7 @@ def add_friend():
             notes=data.get('notes', '')
         )
         db.session.add(friend)
+        bump_data_version(current_user.id)
         db.session.commit()
         logger.info(f"Friend {friend.name} added by user {current_user.username}")
         return jsonify({'success': True, 'id': friend.id}), 201
@@ -236,6 +332,38 @@ def add_friend():
         return jsonify({'success': False, 'error': str(e)}), 400
 
 
+IMPORT_MIMETYPES = {
+    'text/csv': 'csv',
+    'application/x-ndjson': 'ndjson',
+    'application/ndjson': 'ndjson',
+    'application/jsonl': 'ndjson'
+}
+
+
+@api_bp.route('/friends/import', methods=['POST'])
+@login_required
+@limiter.limit("10 per hour")
+def import_friends():
+    """Bulk-add friends from a CSV or NDJSON request body, streamed in batches"""
+    fmt = request.args.get('format') or IMPORT_MIMETYPES.get(request.mimetype)
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({'success': False, 'error': 'Send text/csv or application/x-ndjson (or ?format=csv|ndjson)'}), 415
+    
+    try:
+        report = import_friend_rows(
+            current_user.id,
+            parse_friend_rows(io.BufferedReader(request.stream), fmt),
+            batch_size=current_app.config['IMPORT_BATCH_SIZE'],
+            max_errors=current_app.config['IMPORT_MAX_ERRORS']
+        )
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error importing friends for user {current_user.username}: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 400
+    logger.info(f"{report['imported']} friends imported by user {current_user.username}")
+    return jsonify({'success': True, **report})
+
+
 @api_bp.route('/friends/<int:friend_id>', methods=['PUT'])
 @login_required
 @limiter.limit("50 per hour")
@@ -251,6 +379,11 @@ def update_friend(friend_id):
         friend.phone = data.get('phone', friend.phone)
         friend.relationship = data.get('relationship', friend.relationship)
         friend.notes = data.get('notes', friend.notes)
+        # Pre-generated messages were written for the old name/relationship
+        if db.inspect(friend).attrs.name.history.has_changes() or \
+                db.inspect(friend).attrs.relationship.history.has_changes():
+            MessageDraft.query.filter_by(friend_id=friend.id).delete()
+        bump_data_version(current_user.id)
         db.session.commit()
         logger.info(f"Friend {friend.name} updated by user {current_user.username}")
         return jsonify({'success': True})
@@ -266,6 +399,7 @@ def delete_friend(friend_id):
     """Delete a friend"""
     friend = Friend.query.filter_by(id=friend_id, user_id=current_user.id).first_or_404()
     db.session.delete(friend)
+    bump_data_version(current_user.id)
     db.session.commit()
     logger.info(f"Friend {friend.name} deleted by user {current_user.username}")
     return jsonify({'success': True})
@@ -274,71 +408,283 @@ def delete_friend(friend_id):
 @api_bp.route('/alerts', methods=['GET'])
 @login_required
 @limiter.limit("100 per hour")
+@conditional_response(_alerts_version)
+@cached_response()
 def get_alerts():
-    """Get alerts for current user's friends"""
-    friend_ids = [f.id for f in current_user.friends]
-    alerts = Alert.query.filter(Alert.friend_id.in_(friend_ids)).order_by(Alert.created_at.desc()).limit(50).all()
-    return jsonify([{
-        'id': a.id,
-        'friend_id': a.friend_id,
-        'alert_type': a.alert_type,
-        'message': a.message,
-        'created_at': a.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-        'is_read': a.is_read
-    } for a in alerts])
+    """Get a page of the current user's alerts, newest first"""
+    try:
+        return _paged_response(*read_models.alerts_page(current_user.id, *_page_args()))
+    except ValueError as e:
+        return _bad_cursor(e)
 
 
 @api_bp.route('/alerts/<int:alert_id>/read', methods=['PUT'])
 @login_required
 def mark_alert_read(alert_id):
     """Mark alert as read"""
-    alert = Alert.query.get_or_404(alert_id)
-    # Verify user owns this alert's friend
-    if alert.friend.user_id != current_user.id:
+    alert = db.get_or_404(Alert, alert_id)
+    if alert.user_id != current_user.id:
         return jsonify({'error': 'Unauthorized'}), 403
     alert.is_read = True
+    bump_data_version(current_user.id)
     db.session.commit()
     return jsonify({'success': True})
 
 
+@api_bp.route('/alerts/stream', methods=['GET'])
+@login_required
+@limiter.limit("60 per hour")
+def stream_alerts():
+    """Push the current user's new alerts as Server-Sent Events"""
+    if not current_app.config['ALERT_STREAM_ENABLED']:
+        return jsonify({'error': 'Alert streaming is disabled'}), 404
+    
+    user_id = current_user.id
+    broadcaster = get_broadcaster(current_app._get_current_object())
+    heartbeat = current_app.config['ALERT_STREAM_HEARTBEAT_SECONDS']
+    max_seconds = current_app.config['ALERT_STREAM_MAX_SECONDS']
+    
+    # Alerts missed while the browser was reconnecting
+    backlog = []
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    if last_event_id is not None:
+        backlog = db.session.execute(
+            db.select(*alert_columns())
+            .where(Alert.user_id == user_id, Alert.id > last_event_id)
+            .order_by(Alert.id).limit(current_app.config['API_PAGE_SIZE'])
+        ).all()
+    events = broadcaster.subscribe(user_id)
+    
+    def stream():
+        # No app context in here: the connection may stay open for an hour
+        try:
+            yield 'retry: 5000\n\n'
+            for alert in backlog:
+                yield alert_event(alert)
+            deadline = time.monotonic() + max_seconds
+            while time.monotonic() < deadline:
+                try:
+                    yield alert_event(events.get(timeout=heartbeat))
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+        finally:
+            broadcaster.unsubscribe(user_id, events)
+    
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+
+def _unread_alert_count():
+    """Count of the current user's unread alerts (index-only on user_id, is_read)"""
+    return Alert.query.filter_by(user_id=current_user.id, is_read=False).count()
+
+
+@api_bp.route('/alerts/read', methods=['POST'])
+@login_required
+@limiter.limit("100 per hour")
+def mark_alerts_read():
+    """Mark many alerts as read in one UPDATE: {"ids": [...]}, {"before": "YYYY-MM-DD HH:MM:SS"} or {"all": true}"""
+    data = request.get_json(silent=True) or {}
+    query = Alert.query.filter_by(user_id=current_user.id, is_read=False)
+    if 'ids' in data:
+        ids = data['ids']
+        if not isinstance(ids, list) or not all(isinstance(i, int) for i in ids):
+            return jsonify({'success': False, 'error': 'ids must be a list of integers'}), 400
+        if len(ids) > current_app.config['API_MAX_PAGE_SIZE']:
+            return jsonify({'success': False, 'error': f"At most {current_app.config['API_MAX_PAGE_SIZE']} ids per request"}), 400
+        query = query.filter(Alert.id.in_(ids))
+    elif 'before' in data:
+        try:
+            before = datetime.strptime(data['before'], '%Y-%m-%d %H:%M:%S')
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': 'before must be YYYY-MM-DD HH:MM:SS'}), 400
+        # created_at is stored with microseconds; include the whole second
+        query = query.filter(Alert.created_at < before + timedelta(seconds=1))
+    elif data.get('all') is not True:
+        return jsonify({'success': False, 'error': 'Send ids, before or all'}), 400
+    
+    updated = query.update({Alert.is_read: True}, synchronize_session=False)
+    if updated:
+        bump_data_version(current_user.id)
+    db.session.commit()
+    return jsonify({'success': True, 'updated': updated, 'unread': _unread_alert_count()})
+
+
+@api_bp.route('/alerts/unread-count', methods=['GET'])
+@login_required
+@limiter.limit("300 per hour")
+@cached_response()
+def get_unread_alert_count():
+    """Number of unread alerts, for the notification badge"""
+    return jsonify({'unread': _unread_alert_count()})
+
+
 @api_bp.route('/messages/<int:friend_id>', methods=['GET'])
 @login_required
+@conditional_response(_messages_version)
 def get_friend_messages(friend_id):
-    """Get messages for a friend"""
-    friend = Friend.query.filter_by(id=friend_id, user_id=current_user.id).first_or_404()
-    messages = BirthdayMessage.query.filter_by(friend_id=friend_id).order_by(BirthdayMessage.sent_at.desc()).all()
-    return jsonify([{
-        'id': m.id,
-        'message': m.message,
-        'sent_at': m.sent_at.strftime('%Y-%m-%d %H:%M:%S'),
-        'year': m.year,
-        'email_sent': m.email_sent
-    } for m in messages])
+    """Get a page of messages for a friend, newest first"""
+    owned = db.session.execute(
+        db.select(Friend.id).where(Friend.id == friend_id, Friend.user_id == current_user.id)
+    ).first()
+    if owned is None:
+        abort(404)
+    try:
+        return _paged_response(*read_models.messages_page(current_user.id, friend_id, *_page_args()))
+    except ValueError as e:
+        return _bad_cursor(e)
+
+
+@api_bp.route('/export', methods=['GET'])
+@login_required
+@limiter.limit("10 per hour")
+def export_data():
+    """Stream the current user's friends and messages as a ZIP of CSVs, NDJSON, or one CSV (?data=)"""
+    fmt = request.args.get('format', 'zip')
+    data = request.args.get('data', 'friends')
+    batch_size = current_app.config['EXPORT_BATCH_SIZE']
+    user_id = current_user.id
+    stamp = datetime.now().strftime('%Y-%m-%d')
+    
+    def csv_chunks(data):
+        return stream_csv(export_rows(user_id, data, batch_size), EXPORT_COLUMNS[data], batch_size)
+    
+    def records():
+        for data in EXPORT_COLUMNS:
+            for row in export_rows(user_id, data, batch_size):
+                yield {'type': data, **row}
+    
+    if fmt == 'zip':
+        body = stream_zip((f'{data}.csv', csv_chunks(data)) for data in EXPORT_COLUMNS)
+        mimetype, filename = 'application/zip', f'birthdays-export-{stamp}.zip'
+    elif fmt == 'ndjson':
+        body = stream_ndjson(records(), batch_size)
+        mimetype, filename = 'application/x-ndjson', f'birthdays-export-{stamp}.ndjson'
+    elif fmt == 'csv' and data in EXPORT_COLUMNS:
+        body = csv_chunks(data)
+        mimetype, filename = 'text/csv', f'birthdays-{data}-{stamp}.csv'
+    else:
+        return jsonify({'error': 'format must be zip, ndjson or csv (with data=friends|messages)'}), 400
+    
+    logger.info(f"Export ({fmt}) started by user {current_user.username}")
+    response = Response(stream_with_context(body), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+@api_bp.route('/calendar', methods=['GET'])
+@login_required
+def get_calendar_subscription():
+    """URL of the current user's iCalendar feed (null until one is created)"""
+    token = current_user.calendar_token
+    return jsonify({'url': url_for('main.calendar_subscription', token=token, _external=True) if token else None})
+
+
+@api_bp.route('/calendar/token', methods=['POST'])
+@login_required
+@limiter.limit("10 per hour")
+def rotate_calendar_token():
+    """Create the iCalendar feed URL, or replace it so the old one stops working"""
+    token = current_user.new_calendar_token()
+    db.session.commit()
+    logger.info(f"Calendar feed token issued for user {current_user.username}")
+    return jsonify({'url': url_for('main.calendar_subscription', token=token, _external=True)})
+
+
+@api_bp.route('/calendar/token', methods=['DELETE'])
+@login_required
+def revoke_calendar_token():
+    """Turn the iCalendar feed off"""
+    current_user.calendar_token = None
+    db.session.commit()
+    return jsonify({'success': True})
 
 
 @api_bp.route('/upcoming-birthdays', methods=['GET'])
 @login_required
 @limiter.limit("100 per hour")
+@conditional_response(_upcoming_version)
+@cached_response(daily=True)
 def get_upcoming_birthdays():
-    """Get upcoming birthdays for current user"""
-    today = datetime.now().date()
-    friends = current_user.friends.all()
-    
-    upcoming = []
-    for friend in friends:
-        birthday_this_year = friend.birthday.replace(year=today.year)
-        if birthday_this_year < today:
-            birthday_this_year = friend.birthday.replace(year=today.year + 1)
-        
-        days_until = (birthday_this_year - today).days
-        
-        if days_until <= 30:
-            upcoming.append({
-                'id': friend.id,
-                'name': friend.name,
-                'birthday': birthday_this_year.strftime('%Y-%m-%d'),
-                'days_until': days_until
-            })
+    """Get upcoming birthdays for current user (next ``days`` days, default 30)"""
+    days = max(0, min(request.args.get('days', 30, type=int), 366))
+    limit = max(1, min(request.args.get('limit', 100, type=int), 500))
+    return read_models.json_response(read_models.upcoming_birthdays(current_user.id, datetime.now().date(), days, limit))
+
+
+@api_bp.route('/dashboard', methods=['GET'])
+@login_required
+@limiter.limit("100 per hour")
+@conditional_response(_dashboard_version)
+@cached_response(daily=True)
+def get_dashboard():
+    """First page of friends and alerts, unread count and upcoming birthdays in one response"""
+    friends, friends_cursor = read_models.friends_page(current_user.id)
+    alerts, alerts_cursor = read_models.alerts_page(current_user.id)
+    return read_models.json_response({
+        'friends': friends,
+        'friends_next_cursor': friends_cursor,
+        'alerts': alerts,
+        'alerts_next_cursor': alerts_cursor,
+        'unread_alerts': _unread_alert_count(),
+        'upcoming': read_models.upcoming_birthdays(current_user.id, datetime.now().date())
+    })
+
+
+@api_bp.route('/scheduler/status', methods=['GET'])
+@login_required
+def get_scheduler_status():
+    """Show which process currently runs the scheduled jobs"""
+    from services import process_id
+    lease = db.session.get(SchedulerLease, current_app.config['SCHEDULER_LEASE_NAME'])
+    if lease is None:
+        return jsonify({'leader': None, 'this_process': process_id()})
     
-    upcoming.sort(key=lambda x: x['days_until'])
-    return jsonify(upcoming)
+    now = datetime.utcnow()
+    latest_run = db.session.query(db.func.max(BirthdayCheckShard.run_key)).scalar()
+    shards = BirthdayCheckShard.query.filter_by(run_key=latest_run).order_by(BirthdayCheckShard.shard).all()
+    return jsonify({
+        'leader': lease.holder,
+        'is_alive': lease.expires_at is not None and lease.expires_at > now,
+        'heartbeat_at': lease.heartbeat_at.strftime('%Y-%m-%d %H:%M:%S') if lease.heartbeat_at else None,
+        'expires_at': lease.expires_at.strftime('%Y-%m-%d %H:%M:%S') if lease.expires_at else None,
+        'last_run': {
+            'job': lease.last_run_job,
+            'at': lease.last_run_at.strftime('%Y-%m-%d %H:%M:%S') if lease.last_run_at else None,
+            'status': lease.last_run_status
+        },
+        'shards': [{
+            'run': shard.run_key,
+            'shard': shard.shard,
+            'status': shard.status,
+            'worker': shard.claimed_by,
+            'processed': shard.processed,
+            'last_friend_id': shard.last_friend_id
+        } for shard in shards],
+        'this_process': process_id()
+    })
+
+
+@api_bp.route('/metrics', methods=['GET'])
+@login_required
+def get_metrics():
+    """Counters for this worker process"""
+    import metrics
+    counters = metrics.snapshot()
+    return jsonify({
+        'counters': counters,
+        'ai_cache_hit_rate': metrics.hit_rate(counters.get('ai_cache_hits', 0), counters.get('ai_cache_misses', 0)),
+        'response_cache_hit_rate': metrics.hit_rate(
+            counters.get('response_cache_hits', 0), counters.get('response_cache_misses', 0)
+        ),
+        'user_cache_hit_rate': metrics.hit_rate(
+            counters.get('user_cache_hits', 0), counters.get('user_cache_misses', 0)
+        ),
+        # Queries the user loader saved per authenticated request, net of the stamp checks
+        'user_queries_saved_per_request': metrics.hit_rate(
+            counters.get('user_cache_hits', 0) - counters.get('user_cache_stamp_checks', 0),
+            counters.get('user_cache_misses', 0) + counters.get('user_cache_stamp_checks', 0)
+        )
+    })
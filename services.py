@@ -1,43 +1,45 @@
 """
 Service layer for business logic
 """
+from collections import Counter
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import csv
+import hashlib
+import io
+import json
 import openai
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from sqlalchemy import bindparam, delete, event, insert, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 import os
+import socket
+import threading
+import time
+import uuid
+import zipfile
 from app_factory import db
-from models import Friend, BirthdayMessage, Alert
+from mailer import get_pool
+from cache import bump_data_version
+from alert_stream import notify_new_alerts
+import metrics
+from models import (Friend, BirthdayMessage, Alert, OutboxEmail, SchedulerLease, BirthdayCheckShard,
+                    AIMessageCache, MessageDraft, celebration_date, next_occurrence)
 import logging
 
 logger = logging.getLogger(__name__)
 
+# generate_birthday_messages() retries 429s itself, through its TokenBucket;
+# SDK-internal retries would bypass the bucket and multiply requests per message
+openai.max_retries = 0
 
-def send_email(to_email, subject, message):
-    """Send email to friend"""
-    try:
-        smtp_server = os.getenv('SMTP_SERVER', 'smtp.gmail.com')
-        smtp_port = int(os.getenv('SMTP_PORT', 587))
-        smtp_email = os.getenv('SMTP_EMAIL')
-        smtp_password = os.getenv('SMTP_PASSWORD')
-        
-        if not smtp_email or not smtp_password:
-            logger.warning("Email credentials not configured")
-            return False
-        
-        if not to_email:
-            logger.warning("No email address provided")
-            return False
-        
-        # Create message
-        msg = MIMEMultipart('alternative')
-        msg['From'] = smtp_email
-        msg['To'] = to_email
-        msg['Subject'] = subject
-        
-        # Create HTML version
-        html = f"""
+
+def birthday_email_html(message):
+    """HTML body for a birthday email"""
+    return f"""
         <html>
             <body style="font-family: Arial, sans-serif; padding: 20px; background-color: #f5f5f5;">
                 <div style="max-width: 600px; margin: 0 auto; background-color: white; padding: 30px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1);">
@@ -53,49 +55,15 @@ def send_email(to_email, subject, message):
             </body>
         </html>
         """
-        
-        msg.attach(MIMEText(html, 'html'))
-        
-        # Send email
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_email, smtp_password)
-            server.send_message(msg)
-        
-        logger.info(f"Email sent successfully to {to_email}")
-        return True
-    except Exception as e:
-        logger.error(f"Error sending email to {to_email}: {e}")
-        return False
 
 
-def send_password_reset_email(user, token):
-    """Send password reset email to user"""
-    try:
-        smtp_server = os.getenv('SMTP_SERVER', 'smtp.gmail.com')
-        smtp_port = int(os.getenv('SMTP_PORT', 587))
-        smtp_email = os.getenv('SMTP_EMAIL')
-        smtp_password = os.getenv('SMTP_PASSWORD')
-        
-        logger.info(f"Attempting to send password reset email to {user.email}")
-        logger.info(f"SMTP Config - Server: {smtp_server}, Port: {smtp_port}, Email: {smtp_email}, Password set: {bool(smtp_password)}")
-        
-        if not smtp_email or not smtp_password:
-            logger.error("Email credentials not configured - SMTP_EMAIL or SMTP_PASSWORD missing")
-            return False
-        
-        # Create reset URL using environment variable or default to localhost
-        base_url = os.getenv('APP_URL', 'http://127.0.0.1:5000')
-        reset_url = f"{base_url}/auth/reset-password/{token}"
-        
-        # Create message
-        msg = MIMEMultipart('alternative')
-        msg['From'] = smtp_email
-        msg['To'] = user.email
-        msg['Subject'] = 'Password Reset Request - Birthday Reminder App'
-        
-        # Create HTML version
-        html = f"""
+def password_reset_email_html(user, token):
+    """HTML body for a password reset email"""
+    # Create reset URL using environment variable or default to localhost
+    base_url = os.getenv('APP_URL', 'http://127.0.0.1:5000')
+    reset_url = f"{base_url}/auth/reset-password/{token}"
+    
+    return f"""
         <html>
             <body style="font-family: Arial, sans-serif; padding: 20px; background-color: #f5f5f5;">
                 <div style="max-width: 600px; margin: 0 auto; background-color: white; padding: 30px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1);">
@@ -126,19 +94,48 @@ def send_password_reset_email(user, token):
             </body>
         </html>
         """
-        
-        msg.attach(MIMEText(html, 'html'))
-        
-        # Send email
-        logger.info(f"Connecting to SMTP server: {smtp_server}:{smtp_port}")
-        with smtplib.SMTP(smtp_server, smtp_port, timeout=30) as server:
-            logger.info("Starting TLS...")
-            server.starttls()
-            logger.info("Logging in to SMTP server...")
-            server.login(smtp_email, smtp_password)
-            logger.info("Sending message...")
-            server.send_message(msg)
-        
+
+
+PASSWORD_RESET_SUBJECT = 'Password Reset Request - Birthday Reminder App'
+
+
+def deliver_email(to_email, subject, html):
+    """Send an HTML email over the pooled SMTP connection (raises on failure)"""
+    smtp_email = os.getenv('SMTP_EMAIL')
+    smtp_password = os.getenv('SMTP_PASSWORD')
+    
+    if not smtp_email or not smtp_password:
+        raise RuntimeError("Email credentials not configured - SMTP_EMAIL or SMTP_PASSWORD missing")
+    
+    msg = MIMEMultipart('alternative')
+    msg['From'] = smtp_email
+    msg['To'] = to_email
+    msg['Subject'] = subject
+    msg.attach(MIMEText(html, 'html'))
+    
+    get_pool().send(msg)
+
+
+def send_email(to_email, subject, message):
+    """Send email to friend right away"""
+    if not to_email:
+        logger.warning("No email address provided")
+        return False
+    
+    try:
+        deliver_email(to_email, subject, birthday_email_html(message))
+        logger.info(f"Email sent successfully to {to_email}")
+        return True
+    except Exception as e:
+        logger.error(f"Error sending email to {to_email}: {e}")
+        return False
+
+
+def send_password_reset_email(user, token):
+    """Send password reset email to user right away"""
+    try:
+        logger.info(f"Attempting to send password reset email to {user.email}")
+        deliver_email(user.email, PASSWORD_RESET_SUBJECT, password_reset_email_html(user, token))
         logger.info(f"✅ Password reset email sent successfully to {user.email}")
         return True
     except smtplib.SMTPAuthenticationError as e:
@@ -154,102 +151,1032 @@ def send_password_reset_email(user, token):
         return False
 
 
+def queue_email(to_email, subject, html, birthday_message_id=None):
+    """Add an email to the outbox for the dispatcher (the caller commits)"""
+    email = OutboxEmail(
+        to_email=to_email,
+        subject=subject,
+        html=html,
+        birthday_message_id=birthday_message_id
+    )
+    db.session.add(email)
+    return email
+
+
+def queue_password_reset_email(user, token):
+    """Queue a password reset email (the caller commits)"""
+    return queue_email(user.email, PASSWORD_RESET_SUBJECT, password_reset_email_html(user, token))
+
+
+def _claim_outbox_batch(batch_size, lease_seconds):
+    """Lease a batch of due outbox rows to this process; returns (claim, rows)
+    
+    Postgres uses SELECT ... FOR UPDATE SKIP LOCKED so concurrent
+    dispatchers never block each other; SQLite serializes writers, so a
+    single UPDATE over a sub-select claims the rows atomically.
+    """
+    now = datetime.utcnow()
+    claim = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    lease = now + timedelta(seconds=lease_seconds)
+    due = db.and_(
+        OutboxEmail.status == 'pending',
+        OutboxEmail.next_attempt_at <= now,
+        db.or_(OutboxEmail.locked_until.is_(None), OutboxEmail.locked_until < now)
+    )
+    
+    if db.engine.dialect.name == 'postgresql':
+        ids = db.session.scalars(
+            select(OutboxEmail.id).where(due).order_by(OutboxEmail.id)
+            .limit(batch_size).with_for_update(skip_locked=True)
+        ).all()
+        if ids:
+            db.session.execute(
+                update(OutboxEmail).where(OutboxEmail.id.in_(ids))
+                .values(locked_by=claim, locked_until=lease)
+            )
+    else:
+        due_ids = select(OutboxEmail.id).where(due).order_by(OutboxEmail.id).limit(batch_size)
+        db.session.execute(
+            update(OutboxEmail).where(OutboxEmail.id.in_(due_ids.scalar_subquery()))
+            .values(locked_by=claim, locked_until=lease)
+        )
+    db.session.commit()
+    
+    return claim, db.session.execute(
+        select(OutboxEmail.id, OutboxEmail.to_email, OutboxEmail.subject, OutboxEmail.html,
+               OutboxEmail.attempts, OutboxEmail.birthday_message_id)
+        .where(OutboxEmail.locked_by == claim)
+    ).all()
+
+
+def _record_delivery(config, row, error, now):
+    """Mark one leased outbox row sent, or schedule its retry (no commit)"""
+    if error is None:
+        db.session.execute(
+            update(OutboxEmail).where(OutboxEmail.id == row.id)
+            .values(status='sent', sent_at=now, locked_by=None, locked_until=None)
+        )
+        if row.birthday_message_id:
+            db.session.execute(
+                update(BirthdayMessage).where(BirthdayMessage.id == row.birthday_message_id)
+                .values(email_sent=True)
+            )
+        return
+    
+    attempts = row.attempts + 1
+    failed = attempts >= config['OUTBOX_MAX_ATTEMPTS']
+    delay = config['OUTBOX_RETRY_BASE_SECONDS'] * 2 ** row.attempts
+    db.session.execute(
+        update(OutboxEmail).where(OutboxEmail.id == row.id).values(
+            status='failed' if failed else 'pending',
+            attempts=attempts,
+            next_attempt_at=now + timedelta(seconds=delay),
+            last_error=error,
+            locked_by=None,
+            locked_until=None
+        )
+    )
+    logger.warning(f"Email to {row.to_email} failed (attempt {attempts}): {error}")
+
+
+def dispatch_outbox(app):
+    """Deliver due outbox emails through the SMTP pool
+    
+    Failed sends are retried with exponential backoff until
+    OUTBOX_MAX_ATTEMPTS, after which the row is marked failed. Each row is
+    recorded as soon as its send finishes, and the rows still waiting get
+    their lease renewed, so a slow SMTP server never lets another
+    dispatcher re-lease (and resend) part of a batch.
+    """
+    with app.app_context():
+        config = app.config
+        pool = get_pool()
+        # Long enough for one send: two connection attempts, each allowed the SMTP timeout to connect and to send
+        lease_seconds = max(config['OUTBOX_LEASE_SECONDS'], 4 * pool.timeout)
+        claim, batch = _claim_outbox_batch(config['OUTBOX_BATCH_SIZE'], lease_seconds)
+        if not batch:
+            return 0
+        
+        def deliver(row):
+            try:
+                deliver_email(row.to_email, row.subject, row.html)
+                return None
+            except Exception as e:
+                return f"{type(e).__name__}: {e}"
+        
+        sent = 0
+        with ThreadPoolExecutor(max_workers=pool.size, thread_name_prefix='outbox') as executor:
+            futures = {executor.submit(deliver, row): row for row in batch}
+            for future in as_completed(futures):
+                error = future.result()
+                now = datetime.utcnow()
+                _record_delivery(config, futures[future], error, now)
+                db.session.execute(
+                    update(OutboxEmail).where(OutboxEmail.locked_by == claim)
+                    .values(locked_until=now + timedelta(seconds=lease_seconds))
+                )
+                db.session.commit()
+                sent += error is None
+        
+        logger.info(f"Outbox dispatch: {sent} sent, {len(batch) - sent} failed")
+        return sent
+
+
+def prune_outbox(app):
+    """Delete sent outbox rows (and their HTML) older than OUTBOX_RETENTION_DAYS"""
+    with app.app_context():
+        cutoff = datetime.utcnow() - timedelta(days=app.config['OUTBOX_RETENTION_DAYS'])
+        pruned = db.session.execute(
+            delete(OutboxEmail).where(OutboxEmail.status == 'sent', OutboxEmail.sent_at < cutoff)
+        ).rowcount
+        db.session.commit()
+        logger.info(f"Outbox pruned: {pruned} sent emails")
+        return pruned
+
+
+def _fallback_message(friend_name):
+    """Static message used when AI generation fails"""
+    return f"Happy Birthday {friend_name}! 🎉 Wishing you an amazing day filled with love, joy, and wonderful memories!"
+
+
+def _birthday_request(friend_name, relationship=None):
+    """Chat completion parameters for a birthday message"""
+    prompt = f"Write a warm, heartfelt birthday message for {friend_name}"
+    if relationship:
+        prompt += f", who is my {relationship}"
+    prompt += ". Make it personal, genuine, and cheerful. Keep it to 2-3 sentences."
+    
+    return {
+        'model': "gpt-3.5-turbo",
+        'messages': [
+            {"role": "system", "content": "You are a friendly assistant that writes heartfelt birthday messages."},
+            {"role": "user", "content": prompt}
+        ],
+        'max_tokens': 150,
+        'temperature': 0.8
+    }
+
+
+def message_cache_key(friend_name, relationship=None):
+    """Content address of a birthday message: hash of prompt, model and parameters"""
+    request = json.dumps(_birthday_request(friend_name, relationship), sort_keys=True)
+    return hashlib.sha256(request.encode()).hexdigest()
+
+
+def _request_birthday_message(friend_name, relationship=None, timeout=None):
+    """Call OpenAI for a birthday message (raises on failure)"""
+    response = openai.chat.completions.create(
+        **_birthday_request(friend_name, relationship),
+        timeout=timeout
+    )
+    return response.choices[0].message.content.strip()
+
+
 def generate_birthday_message(friend_name, relationship=None):
     """Generate a personalized birthday message using AI"""
     try:
-        prompt = f"Write a warm, heartfelt birthday message for {friend_name}"
-        if relationship:
-            prompt += f", who is my {relationship}"
-        prompt += ". Make it personal, genuine, and cheerful. Keep it to 2-3 sentences."
-        
-        response = openai.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are a friendly assistant that writes heartfelt birthday messages."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=150,
-            temperature=0.8
-        )
-        
-        message = response.choices[0].message.content.strip()
+        message = _request_birthday_message(friend_name, relationship)
         logger.info(f"AI message generated for {friend_name}")
         return message
     except Exception as e:
         logger.warning(f"Error generating AI message: {e}")
-        return f"Happy Birthday {friend_name}! 🎉 Wishing you an amazing day filled with love, joy, and wonderful memories!"
+        return _fallback_message(friend_name)
+
+
+class TokenBucket:
+    """Thread-safe token bucket used to stay under the provider's requests-per-minute"""
+    
+    def __init__(self, requests_per_minute, capacity=1):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """Block until a token is available"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
 
 
-def check_birthdays(app):
-    """Check for upcoming and today's birthdays"""
+def generate_birthday_messages(requests, max_workers=8, requests_per_minute=500,
+                               max_retries=3, timeout=30, fallback=True):
+    """Generate many birthday messages concurrently
+    
+    ``requests`` maps a key (e.g. friend id) to ``(friend_name, relationship)``.
+    At most ``max_workers`` calls are in flight and calls are paced by a token
+    bucket; 429 responses are retried with exponential backoff. Returns a dict
+    of key -> message, with the fallback text (or None if ``fallback`` is
+    False) for requests that failed.
+    """
+    bucket = TokenBucket(requests_per_minute, capacity=max_workers)
+    
+    def generate(friend_name, relationship):
+        for attempt in range(max_retries + 1):
+            bucket.acquire()
+            try:
+                return _request_birthday_message(friend_name, relationship, timeout=timeout)
+            except openai.RateLimitError as e:
+                if attempt == max_retries:
+                    logger.warning(f"Rate limited generating AI message for {friend_name}: {e}")
+                    break
+                retry_after = e.response.headers.get('retry-after') if e.response is not None else None
+                try:
+                    delay = float(retry_after)
+                except (TypeError, ValueError):
+                    delay = min(2 ** attempt, 30)
+                time.sleep(delay)
+            except Exception as e:
+                logger.warning(f"Error generating AI message for {friend_name}: {e}")
+                break
+        return _fallback_message(friend_name) if fallback else None
+    
+    if not requests:
+        return {}
+    
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ai-message') as executor:
+        futures = {
+            key: executor.submit(generate, friend_name, relationship)
+            for key, (friend_name, relationship) in requests.items()
+        }
+        messages = {key: future.result() for key, future in futures.items()}
+    
+    logger.info(f"AI messages generated for {len(messages)} friends")
+    return messages
+
+
+def cached_birthday_messages(app, requests, fallback=True):
+    """Birthday messages for many friends, served from the shared AI message cache
+    
+    Each cache key keeps up to AI_CACHE_VARIANTS messages. While a key has
+    fewer variants a new message is generated (a miss); after that requests
+    rotate through the existing variants, least recently used first. Entries
+    older than AI_CACHE_TTL_DAYS are ignored. ``requests`` and ``fallback``
+    are as for generate_birthday_messages().
+    """
+    config = app.config
+    if not config['AI_CACHE_ENABLED']:
+        return generate_birthday_messages(requests, fallback=fallback, **_ai_pool_options(config))
+    
+    now = datetime.utcnow()
+    keys = {request_key: message_cache_key(*request) for request_key, request in requests.items()}
+    variants = {}
+    for chunk in _chunked(sorted(set(keys.values())), 500):
+        for entry in db.session.execute(
+            select(AIMessageCache.id, AIMessageCache.cache_key, AIMessageCache.message)
+            .where(AIMessageCache.cache_key.in_(chunk),
+                   AIMessageCache.created_at >= now - timedelta(days=config['AI_CACHE_TTL_DAYS']))
+            .order_by(AIMessageCache.last_used_at)
+        ):
+            variants.setdefault(entry.cache_key, []).append((entry.id, entry.message))
+    
+    # Generate a new variant while the key has room for one, otherwise rotate
+    planned = {key: len(entries) for key, entries in variants.items()}
+    misses = {}
+    for request_key, key in keys.items():
+        if planned.get(key, 0) < config['AI_CACHE_VARIANTS']:
+            planned[key] = planned.get(key, 0) + 1
+            misses[request_key] = requests[request_key]
+    
+    generated = generate_birthday_messages(misses, fallback=False, **_ai_pool_options(config))
+    new_entries = {}
+    for request_key, message in generated.items():
+        if message is not None:
+            new_entries.setdefault(keys[request_key], []).append(message)
+    for key, messages in new_entries.items():
+        ids = db.session.scalars(
+            insert(AIMessageCache).returning(AIMessageCache.id, sort_by_parameter_order=True),
+            [{'cache_key': key, 'message': message, 'created_at': now, 'last_used_at': now}
+             for message in messages]
+        ).all()
+        variants.setdefault(key, []).extend(zip(ids, messages))
+    
+    results = {}
+    used_ids = []
+    rotation = {}
+    for request_key, key in keys.items():
+        if request_key in generated:
+            message = generated[request_key]
+            if message is None and fallback:
+                message = _fallback_message(requests[request_key][0])
+            results[request_key] = message
+            continue
+        entries = variants[key]
+        entry_id, message = entries[rotation.get(key, 0) % len(entries)]
+        rotation[key] = rotation.get(key, 0) + 1
+        used_ids.append(entry_id)
+        results[request_key] = message
+    
+    # One UPDATE per distinct use count (usually just one)
+    uses_by_count = {}
+    for entry_id, uses in Counter(used_ids).items():
+        uses_by_count.setdefault(uses, []).append(entry_id)
+    for uses, ids in uses_by_count.items():
+        db.session.execute(
+            update(AIMessageCache).where(AIMessageCache.id.in_(ids))
+            .values(last_used_at=now, use_count=AIMessageCache.use_count + uses)
+            .execution_options(synchronize_session=False)
+        )
+    
+    hits = len(requests) - len(misses)
+    metrics.incr('ai_cache_hits', hits)
+    metrics.incr('ai_cache_misses', len(misses))
+    logger.info(f"AI message cache: {hits} hits, {len(misses)} misses "
+                f"(hit rate {metrics.hit_rate(hits, len(misses))})")
+    return results
+
+
+def _ai_pool_options(config):
+    """generate_birthday_messages() keyword arguments from app config"""
+    return {
+        'max_workers': config['AI_MAX_CONCURRENCY'],
+        'requests_per_minute': config['AI_REQUESTS_PER_MINUTE'],
+        'max_retries': config['AI_MAX_RETRIES'],
+        'timeout': config['AI_REQUEST_TIMEOUT']
+    }
+
+
+def pregenerate_birthday_messages(app):
+    """Generate drafts for birthdays in the next PREGENERATE_DAYS days
+    
+    Runs off-peak so the birthday itself only sends stored drafts. Friends
+    that already have a draft or a message for that year are skipped; drafts
+    are dropped when a friend's name or relationship is edited.
+    """
     with app.app_context():
         today = datetime.now().date()
-        tomorrow = today + timedelta(days=1)
+        days = app.config['PREGENERATE_DAYS']
+        candidates = Friend.query.filter(
+            Friend.next_birthday.between(today + timedelta(days=1), today + timedelta(days=days))
+        )
+        candidate_ids = candidates.with_entities(Friend.id).scalar_subquery()
+        friends = candidates.with_entities(
+            Friend.id, Friend.name, Friend.next_birthday, Friend.relationship
+        ).order_by(Friend.id).all()
         
-        friends = Friend.query.all()
+        done = set(db.session.execute(
+            select(MessageDraft.friend_id, MessageDraft.year).where(MessageDraft.friend_id.in_(candidate_ids))
+        ).all())
+        done.update(db.session.execute(
+            select(BirthdayMessage.friend_id, BirthdayMessage.year).where(BirthdayMessage.friend_id.in_(candidate_ids))
+        ).all())
+        db.session.commit()
         
+        pending = []
         for friend in friends:
+            year = friend.next_birthday.year
+            if (friend.id, year) not in done:
+                pending.append((friend, year))
+        
+        drafted = 0
+        for chunk in _chunked(pending, app.config['BIRTHDAY_CHECK_BATCH_SIZE']):
             try:
-                birthday_this_year = friend.birthday.replace(year=today.year)
-                
-                # Check if birthday is tomorrow (reminder alert)
-                if birthday_this_year == tomorrow:
-                    existing_alert = Alert.query.filter_by(
-                        friend_id=friend.id,
-                        alert_type='reminder'
-                    ).filter(
-                        db.func.date(Alert.created_at) == today
-                    ).first()
-                    
-                    if not existing_alert:
-                        alert = Alert(
-                            friend_id=friend.id,
-                            alert_type='reminder',
-                            message=f"⏰ Reminder: {friend.name}'s birthday is tomorrow!"
-                        )
-                        db.session.add(alert)
-                        logger.info(f"Reminder alert created for {friend.name}")
-                
-                # Check if birthday is today
-                if birthday_this_year == today:
-                    existing_message = BirthdayMessage.query.filter_by(
-                        friend_id=friend.id,
-                        year=today.year
-                    ).first()
-                    
-                    if not existing_message:
-                        # Generate AI birthday message
-                        ai_message = generate_birthday_message(friend.name, friend.relationship)
-                        
-                        # Send email if available
-                        email_sent = False
-                        if friend.email:
-                            email_sent = send_email(
-                                friend.email,
-                                f"🎉 Happy Birthday {friend.name}!",
-                                ai_message
-                            )
-                        
-                        # Save the message
-                        message = BirthdayMessage(
-                            friend_id=friend.id,
-                            message=ai_message,
-                            year=today.year,
-                            email_sent=email_sent
-                        )
-                        db.session.add(message)
-                        
-                        # Create birthday alert
-                        email_status = "✉️ Email sent!" if email_sent else ("📧 No email address" if not friend.email else "❌ Email failed")
-                        alert = Alert(
-                            friend_id=friend.id,
-                            alert_type='birthday',
-                            message=f"🎂 {friend.name}'s birthday is today! {email_status} Message: {ai_message}"
-                        )
-                        db.session.add(alert)
-                        logger.info(f"Birthday message created for {friend.name}")
-                
+                # No fallback text: failed friends stay undrafted and are retried by the
+                # next pre-generation run or generated on the day
+                messages = cached_birthday_messages(
+                    app, {friend.id: (friend.name, friend.relationship) for friend, _ in chunk}, fallback=False
+                )
+                rows = [
+                    {'friend_id': friend.id, 'year': year, 'message': messages[friend.id]}
+                    for friend, year in chunk if messages.get(friend.id) is not None
+                ]
+                if rows:
+                    db.session.execute(insert(MessageDraft), rows)
                 db.session.commit()
+                drafted += len(rows)
             except Exception as e:
-                logger.error(f"Error processing birthday for {friend.name}: {e}")
+                logger.error(f"Error pre-generating {len(chunk)} birthday messages: {e}")
                 db.session.rollback()
+        
+        logger.info(f"Pre-generated {drafted} birthday messages for the next {days} days")
+        return drafted
+
+
+def roll_next_birthdays(app):
+    """Move friends.next_birthday forward for birthdays that have passed"""
+    with app.app_context():
+        today = datetime.now().date()
+        batch_size = app.config['BIRTHDAY_CHECK_BATCH_SIZE']
+        table = Friend.__table__
+        stmt = update(table).where(table.c.id == bindparam('_id')).values(next_birthday=bindparam('_next'))
+        rolled = 0
+        while True:
+            rows = db.session.execute(
+                select(Friend.id, Friend.birthday)
+                .where(db.or_(Friend.next_birthday < today, Friend.next_birthday.is_(None)))
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            db.session.connection().execute(stmt, [
+                {'_id': row.id, '_next': next_occurrence(row.birthday, today)} for row in rows
+            ])
+            db.session.commit()
+            rolled += len(rows)
+        logger.info(f"Rolled next birthday forward for {rolled} friends")
+        return rolled
+
+
+def prune_message_cache(app):
+    """Drop expired AI cache entries, then the least recently used beyond AI_CACHE_MAX_ENTRIES"""
+    with app.app_context():
+        cutoff = datetime.utcnow() - timedelta(days=app.config['AI_CACHE_TTL_DAYS'])
+        expired = db.session.execute(
+            delete(AIMessageCache).where(AIMessageCache.created_at < cutoff)
+        ).rowcount
+        
+        excess = db.session.scalar(select(db.func.count(AIMessageCache.id))) - app.config['AI_CACHE_MAX_ENTRIES']
+        evicted = 0
+        if excess > 0:
+            oldest = select(AIMessageCache.id).order_by(AIMessageCache.last_used_at).limit(excess)
+            evicted = db.session.execute(
+                delete(AIMessageCache).where(AIMessageCache.id.in_(oldest.scalar_subquery()))
+            ).rowcount
+        db.session.commit()
+        logger.info(f"AI message cache pruned: {expired} expired, {evicted} evicted")
+
+
+class QueryCounter:
+    """Count SQL statements issued on an engine by the current thread"""
+    
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+        self._thread = None
+    
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == self._thread:
+            self.count += 1
+    
+    def __enter__(self):
+        self._thread = threading.get_ident()
+        event.listen(self.engine, 'before_cursor_execute', self._on_execute)
+        return self
+    
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._on_execute)
+
+
+def _insert_skipping_conflicts(model, *columns):
+    """INSERT that silently skips rows clashing with the unique key on ``columns``"""
+    dialect = postgresql if db.engine.dialect.name == 'postgresql' else sqlite
+    return dialect.insert(model).on_conflict_do_nothing(index_elements=list(columns))
+
+
+def _chunked(items, size):
+    """Yield successive ``size``-sized chunks of ``items``"""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def check_birthdays(app, shard=0, shards=1, today=None, after_id=0, checkpoint=None):
+    """Check for upcoming and today's birthdays
+    
+    Runs a constant number of queries per chunk: one to load candidates,
+    one each to pre-load the friends that already have this year's message /
+    today's reminder, then bulk inserts committed in chunks of
+    BIRTHDAY_CHECK_BATCH_SIZE friends.
+    
+    With ``shards`` > 1 only friends whose ``user_id % shards == shard`` are
+    processed. Friends are handled in id order; ``checkpoint(last_id, count)``
+    is called inside each chunk's transaction so a crashed run can resume
+    from ``after_id``.
+    """
+    with app.app_context():
+        today = today or datetime.now().date()
+        tomorrow = today + timedelta(days=1)
+        batch_size = app.config['BIRTHDAY_CHECK_BATCH_SIZE']
+        
+        with QueryCounter(db.engine) as queries:
+            # Only friends whose birthday is today or tomorrow, via the month/day index
+            candidates = Friend.celebrating_on(today, tomorrow)
+            if shards > 1:
+                candidates = candidates.filter(Friend.user_id % shards == shard)
+            if after_id:
+                candidates = candidates.filter(Friend.id > after_id)
+            # Plain rows, so committing a chunk doesn't expire (and reload) the rest
+            friends = candidates.with_entities(
+                Friend.id, Friend.user_id, Friend.name, Friend.birthday,
+                Friend.email, Friend.relationship
+            ).order_by(Friend.id).all()
+            candidate_ids = candidates.with_entities(Friend.id).scalar_subquery()
+            
+            # Friends that already got this year's message / today's reminder
+            messaged_ids = set(db.session.scalars(
+                select(BirthdayMessage.friend_id).where(
+                    BirthdayMessage.year == today.year,
+                    BirthdayMessage.friend_id.in_(candidate_ids)
+                )
+            ))
+            reminded_ids = set(db.session.scalars(
+                select(Alert.friend_id).where(
+                    Alert.alert_type == 'reminder',
+                    db.func.date(Alert.created_at) == today,
+                    Alert.friend_id.in_(candidate_ids)
+                )
+            ))
+            # End the read transaction before the (slow) AI calls
+            db.session.commit()
+            
+            messages_saved = alerts_saved = 0
+            for chunk in _chunked(friends, batch_size):
+                try:
+                    messages, alerts = _process_birthday_chunk(app, chunk, today, messaged_ids, reminded_ids)
+                    if checkpoint:
+                        checkpoint(chunk[-1].id, len(chunk))
+                    db.session.commit()
+                    messages_saved += messages
+                    alerts_saved += alerts
+                except Exception as e:
+                    logger.error(f"Error processing birthdays for {len(chunk)} friends: {e}")
+                    db.session.rollback()
+        
+        logger.info(
+            f"Birthday check finished: {len(friends)} candidates, {messages_saved} messages, "
+            f"{alerts_saved} alerts, {queries.count} queries"
+        )
+        return messages_saved, alerts_saved
+
+
+def _process_birthday_chunk(app, friends, today, messaged_ids, reminded_ids):
+    """Write reminders, birthday messages and queued emails for one chunk (no commit)"""
+    tomorrow = today + timedelta(days=1)
+    alert_rows = []
+    birthday_friends = []
+    for friend in friends:
+        # Check if birthday is tomorrow (reminder alert)
+        if celebration_date(friend.birthday, tomorrow.year) == tomorrow and friend.id not in reminded_ids:
+            alert_rows.append({
+                'friend_id': friend.id,
+                'user_id': friend.user_id,
+                'alert_type': 'reminder',
+                'message': f"⏰ Reminder: {friend.name}'s birthday is tomorrow!"
+            })
+            logger.info(f"Reminder alert created for {friend.name}")
+        
+        # Check if birthday is today
+        if celebration_date(friend.birthday, today.year) == today and friend.id not in messaged_ids:
+            birthday_friends.append(friend)
+    
+    if birthday_friends:
+        # Drafts pre-generated off-peak, then the cache / AI for the rest
+        birthday_ids = [friend.id for friend in birthday_friends]
+        ai_messages = dict(db.session.execute(
+            select(MessageDraft.friend_id, MessageDraft.message)
+            .where(MessageDraft.friend_id.in_(birthday_ids), MessageDraft.year == today.year)
+        ).all())
+        ai_messages.update(cached_birthday_messages(app, {
+            friend.id: (friend.name, friend.relationship)
+            for friend in birthday_friends if friend.id not in ai_messages
+        }))
+        db.session.execute(
+            delete(MessageDraft)
+            .where(MessageDraft.friend_id.in_(birthday_ids), MessageDraft.year == today.year)
+        )
+        
+        # Save the messages, then queue emails referencing them. Friends another run
+        # messaged meanwhile (a reclaimed shard, overlapping jobs) are skipped here.
+        message_ids = dict(db.session.execute(
+            _insert_skipping_conflicts(BirthdayMessage, 'friend_id', 'year')
+            .returning(BirthdayMessage.friend_id, BirthdayMessage.id),
+            [{'friend_id': friend.id, 'user_id': friend.user_id, 'message': ai_messages[friend.id], 'year': today.year}
+             for friend in birthday_friends]
+        ).all())
+        birthday_friends = [friend for friend in birthday_friends if friend.id in message_ids]
+        
+        outbox_rows = [{
+            'to_email': friend.email,
+            'subject': f"🎉 Happy Birthday {friend.name}!",
+            'html': birthday_email_html(ai_messages[friend.id]),
+            'birthday_message_id': message_ids[friend.id]
+        } for friend in birthday_friends if friend.email]
+        if outbox_rows:
+            db.session.execute(insert(OutboxEmail), outbox_rows)
+        
+        for friend in birthday_friends:
+            # Create birthday alert
+            email_status = "✉️ Email queued!" if friend.email else "📧 No email address"
+            alert_rows.append({
+                'friend_id': friend.id,
+                'user_id': friend.user_id,
+                'alert_type': 'birthday',
+                'message': f"🎂 {friend.name}'s birthday is today! {email_status} Message: {ai_messages[friend.id]}"
+            })
+            logger.info(f"Birthday message created for {friend.name}")
+    
+    if alert_rows:
+        db.session.execute(insert(Alert), alert_rows)
+        bump_data_version(*(row['user_id'] for row in alert_rows))
+        notify_new_alerts()
+    return len(birthday_friends), len(alert_rows)
+
+
+_process_id = None
+
+
+def process_id():
+    """Identifier of this process, unique across hosts and restarts"""
+    global _process_id
+    if _process_id is None or _process_id[1] != os.getpid():
+        _process_id = (f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}", os.getpid())
+    return _process_id[0]
+
+
+def acquire_lease(name, ttl_seconds):
+    """Take or renew the named lease; returns True if this process holds it
+    
+    The lease can be taken over once its holder has stopped renewing it for
+    ``ttl_seconds``, which is how a new leader is elected when one dies.
+    """
+    now = datetime.utcnow()
+    me = process_id()
+    values = {'holder': me, 'expires_at': now + timedelta(seconds=ttl_seconds), 'heartbeat_at': now}
+    
+    try:
+        result = db.session.execute(
+            update(SchedulerLease)
+            .where(SchedulerLease.name == name,
+                   db.or_(SchedulerLease.holder == me, SchedulerLease.expires_at < now))
+            .values(**values)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount:
+            db.session.commit()
+            return True
+        
+        if db.session.get(SchedulerLease, name) is not None:
+            db.session.commit()
+            return False
+        
+        db.session.add(SchedulerLease(name=name, **values))
+        db.session.commit()
+        return True
+    except IntegrityError:
+        # Another process created the lease row first
+        db.session.rollback()
+        return False
+
+
+def record_job_run(name, job, status):
+    """Store the outcome of a leader-only job on its lease row"""
+    db.session.execute(
+        update(SchedulerLease).where(SchedulerLease.name == name)
+        .values(last_run_job=job, last_run_at=datetime.utcnow(), last_run_status=status[:255])
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+
+def scheduler_heartbeat(app):
+    """Renew (or try to take over) the scheduler lease"""
+    with app.app_context():
+        try:
+            if acquire_lease(app.config['SCHEDULER_LEASE_NAME'], app.config['SCHEDULER_LEASE_SECONDS']):
+                logger.debug(f"Scheduler lease held by {process_id()}")
+        except Exception as e:
+            logger.error(f"Scheduler heartbeat failed: {e}")
+            db.session.rollback()
+
+
+def run_as_leader(app, job, func):
+    """Run ``func(app)`` only if this process holds the scheduler lease"""
+    name = app.config['SCHEDULER_LEASE_NAME']
+    with app.app_context():
+        if not acquire_lease(name, app.config['SCHEDULER_LEASE_SECONDS']):
+            return
+    
+    try:
+        func(app)
+        status = 'ok'
+    except Exception as e:
+        logger.error(f"Scheduled job {job} failed: {e}")
+        status = f"error: {e}"
+    
+    with app.app_context():
+        record_job_run(name, job, status)
+
+
+def seed_birthday_check(shards, today=None):
+    """Create the shard rows for this hour's birthday check (idempotent)"""
+    now = datetime.now()
+    today = today or now.date()
+    run_key = f"{today.isoformat()}T{now.hour:02d}"
+    existing = set(db.session.scalars(
+        select(BirthdayCheckShard.shard).where(BirthdayCheckShard.run_key == run_key)
+    ))
+    rows = [
+        {'run_key': run_key, 'run_date': today, 'shard': shard, 'shards': shards}
+        for shard in range(shards) if shard not in existing
+    ]
+    if rows:
+        try:
+            db.session.execute(insert(BirthdayCheckShard), rows)
+            db.session.commit()
+            logger.info(f"Birthday check {run_key} split into {shards} shards")
+        except IntegrityError:
+            # Another process seeded the same run
+            db.session.rollback()
+    return run_key
+
+
+def claim_birthday_shard(today, lease_seconds):
+    """Claim a pending shard of today's run, or one whose worker stopped renewing"""
+    now = datetime.utcnow()
+    claimable = db.and_(
+        BirthdayCheckShard.run_date == today,
+        db.or_(
+            BirthdayCheckShard.status == 'pending',
+            db.and_(BirthdayCheckShard.status == 'running', BirthdayCheckShard.lease_until < now)
+        )
+    )
+    next_id = select(BirthdayCheckShard.id).where(claimable).order_by(BirthdayCheckShard.id).limit(1)
+    
+    for _ in range(3):
+        shard_id = db.session.scalar(next_id)
+        if shard_id is None:
+            db.session.commit()
+            return None
+        # Re-check the condition so two workers never claim the same shard
+        result = db.session.execute(
+            update(BirthdayCheckShard)
+            .where(BirthdayCheckShard.id == shard_id, claimable)
+            .values(status='running', claimed_by=process_id(),
+                    lease_until=now + timedelta(seconds=lease_seconds),
+                    started_at=db.func.coalesce(BirthdayCheckShard.started_at, now))
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        if result.rowcount:
+            return db.session.get(BirthdayCheckShard, shard_id)
+    return None
+
+
+class ShardLeaseHeartbeat:
+    """Renew a claimed shard's lease from a background thread while it is processed
+    
+    One chunk's AI calls can take longer than BIRTHDAY_SHARD_LEASE_SECONDS;
+    without renewal another worker would reclaim the shard and redo the chunk.
+    """
+    
+    def __init__(self, app, shard_id, lease_seconds):
+        self.app = app
+        self.shard_id = shard_id
+        self.lease_seconds = lease_seconds
+        self._stop = threading.Event()
+        self._thread = None
+    
+    def _renew(self, holder):
+        while not self._stop.wait(self.lease_seconds / 3):
+            try:
+                with self.app.app_context(), db.engine.begin() as conn:
+                    renewed = conn.execute(
+                        update(BirthdayCheckShard.__table__)
+                        .where(BirthdayCheckShard.id == self.shard_id, BirthdayCheckShard.claimed_by == holder,
+                               BirthdayCheckShard.status == 'running')
+                        .values(lease_until=datetime.utcnow() + timedelta(seconds=self.lease_seconds))
+                    ).rowcount
+                if not renewed:
+                    logger.warning(f"Lost the lease on birthday shard {self.shard_id}")
+                    return
+            except Exception as e:
+                logger.error(f"Renewing the lease on birthday shard {self.shard_id} failed: {e}")
+    
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._renew, args=(process_id(),),
+                                        name=f'shard-lease-{self.shard_id}', daemon=True)
+        self._thread.start()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def process_birthday_shards(app):
+    """Claim and process shards of today's birthday check until none are left
+    
+    Progress is checkpointed per chunk and the lease is renewed while the
+    shard runs, so only a shard whose worker crashed is picked up by another
+    worker, from its last committed friend id.
+    """
+    processed = 0
+    with app.app_context():
+        lease_seconds = app.config['BIRTHDAY_SHARD_LEASE_SECONDS']
+        while True:
+            shard = claim_birthday_shard(datetime.now().date(), lease_seconds)
+            if shard is None:
+                return processed
+            
+            shard_id = shard.id
+            logger.info(f"Processing birthday shard {shard.shard}/{shard.shards} of {shard.run_key} "
+                        f"from friend {shard.last_friend_id}")
+            
+            def checkpoint(last_id, count):
+                db.session.execute(
+                    update(BirthdayCheckShard).where(BirthdayCheckShard.id == shard_id)
+                    .values(last_friend_id=last_id,
+                            processed=BirthdayCheckShard.processed + count,
+                            lease_until=datetime.utcnow() + timedelta(seconds=lease_seconds))
+                    .execution_options(synchronize_session=False)
+                )
+            
+            with ShardLeaseHeartbeat(app, shard_id, lease_seconds):
+                check_birthdays(app, shard=shard.shard, shards=shard.shards, today=shard.run_date,
+                                after_id=shard.last_friend_id, checkpoint=checkpoint)
+            db.session.execute(
+                update(BirthdayCheckShard).where(BirthdayCheckShard.id == shard_id)
+                .values(status='done', finished_at=datetime.utcnow(), lease_until=None)
+                .execution_options(synchronize_session=False)
+            )
+            db.session.commit()
+            processed += 1
+
+
+def scheduled_birthday_check(app):
+    """Leader job: run the birthday check, or split it into shards for all workers"""
+    shards = app.config['BIRTHDAY_CHECK_SHARDS']
+    if shards <= 1:
+        return check_birthdays(app)
+    with app.app_context():
+        seed_birthday_check(shards)
+
+
+# Columns accepted by the friend import and their maximum lengths
+IMPORT_FIELDS = {'name': 100, 'birthday': None, 'email': 120, 'phone': 20, 'relationship': 50, 'notes': None}
+
+
+def parse_friend_rows(stream, fmt):
+    """Yield (line, fields) from a binary CSV or NDJSON stream without reading it all
+
+    ``fields`` is a dict, or an error string when the line could not be parsed.
+    """
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', errors='replace', newline='')
+    if fmt == 'csv':
+        reader = csv.DictReader(text)
+        for fields in reader:
+            yield reader.line_num, fields
+        return
+    for line, raw in enumerate(text, start=1):
+        if not raw.strip():
+            continue
+        try:
+            fields = json.loads(raw)
+        except json.JSONDecodeError as e:
+            yield line, f"Invalid JSON: {e.msg}"
+            continue
+        yield line, fields if isinstance(fields, dict) else "Expected a JSON object"
+
+
+def _validate_friend_row(fields, today):
+    """Column values for one imported friend; raises ValueError on bad input"""
+    row = {}
+    for field, max_length in IMPORT_FIELDS.items():
+        value = fields.get(field)
+        value = '' if value is None else str(value).strip()
+        if max_length and len(value) > max_length:
+            raise ValueError(f"{field} is longer than {max_length} characters")
+        row[field] = value
+    if not row['name']:
+        raise ValueError("name is required")
+    try:
+        row['birthday'] = datetime.strptime(row['birthday'], '%Y-%m-%d').date()
+    except ValueError:
+        raise ValueError("birthday must be YYYY-MM-DD")
+    row.update(Friend.derived_fields(row['birthday'], today))
+    return row
+
+
+def import_friend_rows(user_id, rows, batch_size=1000, max_errors=1000):
+    """Insert friends for ``user_id`` from parse_friend_rows() output in batches
+
+    Each batch is committed on its own, so memory stays flat and earlier
+    batches survive a failure later in the file. Returns a report with the
+    number imported and the first ``max_errors`` row errors.
+    """
+    today = datetime.now().date()
+    report = {'imported': 0, 'failed': 0, 'errors': []}
+    batch = []
+    
+    def flush():
+        db.session.execute(insert(Friend), batch)
+        bump_data_version(user_id)
+        db.session.commit()
+        report['imported'] += len(batch)
+        batch.clear()
+    
+    for line, fields in rows:
+        try:
+            if isinstance(fields, str):
+                raise ValueError(fields)
+            row = _validate_friend_row(fields, today)
+        except ValueError as e:
+            report['failed'] += 1
+            if len(report['errors']) < max_errors:
+                report['errors'].append({'line': line, 'error': str(e)})
+            continue
+        row['user_id'] = user_id
+        batch.append(row)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    
+    report['errors_truncated'] = report['failed'] > len(report['errors'])
+    logger.info(f"Imported {report['imported']} friends for user {user_id} ({report['failed']} rows rejected)")
+    return report
+
+
+# Columns written by the export, in order
+EXPORT_COLUMNS = {
+    'friends': ['id', 'name', 'birthday', 'email', 'phone', 'relationship', 'notes', 'created_at'],
+    'messages': ['id', 'friend_id', 'friend_name', 'year', 'message', 'sent_at', 'email_sent']
+}
+
+
+def export_rows(user_id, data, batch_size=1000):
+    """Yield the user's friends or messages as dicts, fetched ``batch_size`` rows at a time"""
+    if data == 'friends':
+        stmt = select(
+            Friend.id, Friend.name, Friend.birthday, Friend.email, Friend.phone,
+            Friend.relationship, Friend.notes, Friend.created_at
+        ).where(Friend.user_id == user_id).order_by(Friend.id)
+    else:
+        stmt = select(
+            BirthdayMessage.id, BirthdayMessage.friend_id, Friend.name.label('friend_name'), BirthdayMessage.year,
+            BirthdayMessage.message, BirthdayMessage.sent_at, BirthdayMessage.email_sent
+        ).join(Friend, BirthdayMessage.friend_id == Friend.id).where(
+            BirthdayMessage.user_id == user_id
+        ).order_by(BirthdayMessage.id)
+    
+    # yield_per streams from a server-side cursor where the driver supports one
+    for row in db.session.execute(stmt.execution_options(yield_per=batch_size)):
+        row = row._asdict()
+        for key in ('birthday', 'created_at', 'sent_at'):
+            if row.get(key) is not None:
+                row[key] = row[key].strftime('%Y-%m-%d' if key == 'birthday' else '%Y-%m-%d %H:%M:%S')
+        yield row
+
+
+def stream_csv(rows, columns, batch_size=1000):
+    """Encode dict rows as CSV text, one chunk per ``batch_size`` rows"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns)
+    writer.writeheader()
+    for count, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if count % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def stream_ndjson(rows, batch_size=1000):
+    """Encode dict rows as newline-delimited JSON, one chunk per ``batch_size`` rows"""
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(row, ensure_ascii=False))
+        if len(lines) >= batch_size:
+            yield '\n'.join(lines) + '\n'
+            lines.clear()
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+class _ZipChunks:
+    """Write-only, unseekable file for zipfile that hands written bytes back out"""
+    
+    def __init__(self):
+        self.chunks = []
+    
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def stream_zip(files):
+    """Build a ZIP archive of (name, text chunks) pairs, yielding bytes as it goes"""
+    out = _ZipChunks()
+    with zipfile.ZipFile(out, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, chunks in files:
+            with archive.open(name, 'w', force_zip64=True) as member:
+                for chunk in chunks:
+                    member.write(chunk.encode())
+                    yield out.drain()
+    yield out.drain()
@@ -13,14 +13,77 @@ const closeModal = document.querySelector('.close');
 const cancelEditBtn = document.getElementById('cancel-edit');
 const formTitle = document.getElementById('form-title');
 
+// Last ETag, body and next-page cursor per URL, for conditional GETs
+const responseCache = new Map();
+
+// created_at of the newest alert shown, so "Mark All Read" skips alerts that arrive later
+let newestAlertTime = null;
+
+// GET a JSON page, sending If-None-Match and reusing the stored page on 304
+async function fetchPage(url) {
+    const cached = responseCache.get(url);
+    const headers = cached ? { 'If-None-Match': cached.etag } : {};
+    const response = await fetch(url, { headers });
+    
+    if (response.status === 304 && cached) {
+        return cached.page;
+    }
+    if (!response.ok) {
+        throw new Error(`Request failed: ${response.status}`);
+    }
+    
+    const page = { data: await response.json(), next: response.headers.get('X-Next-Cursor') };
+    const etag = response.headers.get('ETag');
+    if (etag) {
+        responseCache.set(url, { etag, page });
+    }
+    return page;
+}
+
+// GET JSON (first page only for paginated endpoints)
+async function fetchJSON(url) {
+    return (await fetchPage(url)).data;
+}
+
+// Loads the next page when a list's sentinel scrolls into view
+const scrollObserver = new IntersectionObserver(entries => {
+    entries.forEach(entry => {
+        if (entry.isIntersecting) {
+            scrollObserver.unobserve(entry.target);
+            entry.target.remove();
+            entry.target.loadMore();
+        }
+    });
+}, { rootMargin: '200px' });
+
+// Render a page into a list, then keep appending pages as the user scrolls
+function appendPage(container, url, page, render) {
+    container.insertAdjacentHTML('beforeend', page.data.map(render).join(''));
+    if (!page.next) {
+        return;
+    }
+    
+    const sentinel = document.createElement('div');
+    sentinel.className = 'scroll-sentinel';
+    sentinel.loadMore = async () => {
+        try {
+            const separator = url.includes('?') ? '&' : '?';
+            const next = await fetchPage(`${url}${separator}cursor=${encodeURIComponent(page.next)}`);
+            appendPage(container, url, next, render);
+        } catch (error) {
+            console.error('Error loading more items:', error);
+        }
+    };
+    container.appendChild(sentinel);
+    scrollObserver.observe(sentinel);
+}
+
 // Initialize the app
 document.addEventListener('DOMContentLoaded', () => {
-    loadFriends();
-    loadAlerts();
-    loadUpcomingBirthdays();
+    loadDashboard();
     
-    // Set up auto-refresh for alerts (every 5 minutes)
-    setInterval(loadAlerts, 300000);
+    // New alerts are pushed by the server; poll every 5 minutes where that's unavailable
+    connectAlertStream();
     
     // Set up event listeners
     friendForm.addEventListener('submit', handleFormSubmit);
@@ -29,6 +92,7 @@ document.addEventListener('DOMContentLoaded', () => {
     
     document.getElementById('refresh-friends').addEventListener('click', loadFriends);
     document.getElementById('refresh-alerts').addEventListener('click', loadAlerts);
+    document.getElementById('mark-all-read').addEventListener('click', markAllAlertsRead);
     
     // Close modal when clicking outside
     window.addEventListener('click', (e) => {
@@ -38,24 +102,42 @@ document.addEventListener('DOMContentLoaded', () => {
     });
 });
 
-// Load all friends
+// Load friends, alerts and upcoming birthdays in one request
+async function loadDashboard() {
+    try {
+        const dashboard = await fetchJSON(`${API_BASE}/dashboard`);
+        renderFriends({ data: dashboard.friends, next: dashboard.friends_next_cursor });
+        renderAlerts({ data: dashboard.alerts, next: dashboard.alerts_next_cursor });
+        showUnreadCount(dashboard.unread_alerts);
+        renderUpcoming(dashboard.upcoming);
+    } catch (error) {
+        console.error('Error loading dashboard:', error);
+        loadFriends();
+        loadAlerts();
+        loadUpcomingBirthdays();
+    }
+}
+
+// Load friends
 async function loadFriends() {
     try {
-        const response = await fetch(`${API_BASE}/friends`);
-        const friends = await response.json();
-        
-        if (friends.length === 0) {
-            friendsContainer.innerHTML = '<div class="no-friends"><i class="fas fa-user-friends fa-3x" style="opacity: 0.3; margin-bottom: 20px;"></i><br>No friends added yet. Add your first friend above!</div>';
-            return;
-        }
-        
-        friendsContainer.innerHTML = friends.map(friend => createFriendCard(friend)).join('');
+        renderFriends(await fetchPage(`${API_BASE}/friends`));
     } catch (error) {
         console.error('Error loading friends:', error);
         friendsContainer.innerHTML = '<div class="no-friends" style="color: #dc3545;">Error loading friends. Please try again.</div>';
     }
 }
 
+function renderFriends(page) {
+    if (page.data.length === 0) {
+        friendsContainer.innerHTML = '<div class="no-friends"><i class="fas fa-user-friends fa-3x" style="opacity: 0.3; margin-bottom: 20px;"></i><br>No friends added yet. Add your first friend above!</div>';
+        return;
+    }
+    
+    friendsContainer.innerHTML = '';
+    appendPage(friendsContainer, `${API_BASE}/friends`, page, createFriendCard);
+}
+
 // Create friend card HTML
 function createFriendCard(friend) {
     const birthday = new Date(friend.birthday + 'T00:00:00');
@@ -90,21 +172,92 @@ function createFriendCard(friend) {
 // Load alerts
 async function loadAlerts() {
     try {
-        const response = await fetch(`${API_BASE}/alerts`);
-        const alerts = await response.json();
-        
-        if (alerts.length === 0) {
-            alertsContainer.innerHTML = '<div class="no-alerts"><i class="fas fa-bell-slash fa-3x" style="opacity: 0.3; margin-bottom: 15px;"></i><br>No alerts yet. We\'ll notify you about upcoming birthdays!</div>';
-            return;
-        }
-        
-        alertsContainer.innerHTML = alerts.map(alert => createAlertItem(alert)).join('');
+        const page = await fetchPage(`${API_BASE}/alerts`);
+        loadUnreadCount();
+        renderAlerts(page);
     } catch (error) {
         console.error('Error loading alerts:', error);
         alertsContainer.innerHTML = '<div class="no-alerts" style="color: #dc3545;">Error loading alerts.</div>';
     }
 }
 
+function renderAlerts(page) {
+    newestAlertTime = page.data.length ? page.data[0].created_at : null;
+    
+    if (page.data.length === 0) {
+        alertsContainer.innerHTML = '<div class="no-alerts"><i class="fas fa-bell-slash fa-3x" style="opacity: 0.3; margin-bottom: 15px;"></i><br>No alerts yet. We\'ll notify you about upcoming birthdays!</div>';
+        return;
+    }
+    
+    alertsContainer.innerHTML = '';
+    appendPage(alertsContainer, `${API_BASE}/alerts`, page, createAlertItem);
+}
+
+// Reload alerts whenever the server pushes a new one
+function connectAlertStream() {
+    if (!window.EventSource) {
+        startAlertPolling();
+        return;
+    }
+    
+    const source = new EventSource(`${API_BASE}/alerts/stream`);
+    source.addEventListener('alert', () => loadAlerts());
+    source.onerror = () => {
+        // The browser retries dropped connections itself; CLOSED means the server refused the stream
+        if (source.readyState === EventSource.CLOSED) {
+            startAlertPolling();
+        }
+    };
+}
+
+let alertPoller = null;
+
+function startAlertPolling() {
+    if (alertPoller === null) {
+        alertPoller = setInterval(loadAlerts, 300000);
+    }
+}
+
+// Show the number of unread alerts next to the alerts heading
+async function loadUnreadCount() {
+    try {
+        const { unread } = await fetchJSON(`${API_BASE}/alerts/unread-count`);
+        showUnreadCount(unread);
+    } catch (error) {
+        console.error('Error loading unread count:', error);
+    }
+}
+
+function showUnreadCount(unread) {
+    const badge = document.getElementById('unread-count');
+    badge.textContent = unread;
+    badge.style.display = unread > 0 ? 'inline-block' : 'none';
+}
+
+// Mark every alert shown so far as read in one request
+async function markAllAlertsRead() {
+    if (!newestAlertTime) {
+        return;
+    }
+    
+    try {
+        const response = await fetch(`${API_BASE}/alerts/read`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ before: newestAlertTime })
+        });
+        
+        const result = await response.json();
+        
+        if (result.success) {
+            showUnreadCount(result.unread);
+            loadAlerts();
+        }
+    } catch (error) {
+        console.error('Error marking alerts as read:', error);
+    }
+}
+
 // Create alert item HTML
 function createAlertItem(alert) {
     const alertClass = `alert-${alert.alert_type}`;
@@ -131,21 +284,22 @@ function createAlertItem(alert) {
 // Load upcoming birthdays
 async function loadUpcomingBirthdays() {
     try {
-        const response = await fetch(`${API_BASE}/upcoming-birthdays`);
-        const upcoming = await response.json();
-        
-        if (upcoming.length === 0) {
-            upcomingContainer.innerHTML = '<div class="no-alerts">No birthdays in the next 30 days.</div>';
-            return;
-        }
-        
-        upcomingContainer.innerHTML = upcoming.map(item => createUpcomingCard(item)).join('');
+        renderUpcoming(await fetchJSON(`${API_BASE}/upcoming-birthdays`));
     } catch (error) {
         console.error('Error loading upcoming birthdays:', error);
         upcomingContainer.innerHTML = '<div class="no-alerts" style="color: #dc3545;">Error loading birthdays.</div>';
     }
 }
 
+function renderUpcoming(upcoming) {
+    if (upcoming.length === 0) {
+        upcomingContainer.innerHTML = '<div class="no-alerts">No birthdays in the next 30 days.</div>';
+        return;
+    }
+    
+    upcomingContainer.innerHTML = upcoming.map(item => createUpcomingCard(item)).join('');
+}
+
 // Create upcoming birthday card HTML
 function createUpcomingCard(item) {
     const birthday = new Date(item.birthday + 'T00:00:00');
@@ -203,9 +357,7 @@ async function handleFormSubmit(e) {
 // Edit friend
 async function editFriend(id) {
     try {
-        const response = await fetch(`${API_BASE}/friends`);
-        const friends = await response.json();
-        const friend = friends.find(f => f.id === id);
+        const friend = await fetchJSON(`${API_BASE}/friends/${id}`);
         
         if (friend) {
             document.getElementById('friend-id').value = friend.id;
@@ -255,23 +407,16 @@ async function deleteFriend(id, name) {
 // View messages for a friend
 async function viewMessages(friendId, friendName) {
     try {
-        const response = await fetch(`${API_BASE}/messages/${friendId}`);
-        const messages = await response.json();
+        const url = `${API_BASE}/messages/${friendId}`;
+        const page = await fetchPage(url);
         
         modalTitle.innerHTML = `<i class="fas fa-comments"></i> Birthday Messages for ${escapeHtml(friendName)}`;
         
-        if (messages.length === 0) {
+        if (page.data.length === 0) {
             modalBody.innerHTML = '<div class="no-alerts">No messages sent yet.</div>';
         } else {
-            modalBody.innerHTML = messages.map(msg => `
-                <div class="message-item">
-                    <div class="message-text">${escapeHtml(msg.message)}</div>
-                    <div class="message-meta">
-                        <span><i class="fas fa-calendar"></i> Year: ${msg.year}</span>
-                        <span><i class="fas fa-clock"></i> ${new Date(msg.sent_at).toLocaleString()}</span>
-                    </div>
-                </div>
-            `).join('');
+            modalBody.innerHTML = '';
+            appendPage(modalBody, url, page, createMessageItem);
         }
         
         messageModal.style.display = 'block';
@@ -281,6 +426,19 @@ async function viewMessages(friendId, friendName) {
     }
 }
 
+// Create message item HTML
+function createMessageItem(msg) {
+    return `
+        <div class="message-item">
+            <div class="message-text">${escapeHtml(msg.message)}</div>
+            <div class="message-meta">
+                <span><i class="fas fa-calendar"></i> Year: ${msg.year}</span>
+                <span><i class="fas fa-clock"></i> ${new Date(msg.sent_at).toLocaleString()}</span>
+            </div>
+        </div>
+    `;
+}
+
 // Mark alert as read
 async function markAlertRead(alertId) {
     try {
@@ -0,0 +1,163 @@
+"""
+Upgrade an existing database in place
+Run this after deploying a new version to add new columns and indexes
+(db.create_all() only creates missing tables, never missing columns)
+"""
+import os
+
+# A migration must not start the scheduler (it would join leader election
+# and run jobs against tables that are not upgraded yet); read by config.py
+os.environ['SCHEDULER_ENABLED'] = 'false'
+
+from wsgi import app
+from app_factory import db
+from models import User, Friend, BirthdayMessage, Alert, OutboxEmail
+from sqlalchemy import inspect, select, update, delete, bindparam, or_, func
+from datetime import date
+
+BATCH_SIZE = 1000
+
+
+def add_missing_columns(model):
+    """ALTER TABLE ... ADD COLUMN for model columns the table doesn't have yet"""
+    table = model.__table__
+    existing = {c['name'] for c in inspect(db.engine).get_columns(table.name)}
+    added = []
+    with db.engine.begin() as conn:
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            conn.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}')
+            added.append(column.name)
+    for name in added:
+        print(f'✅ Added column {table.name}.{name}')
+    return added
+
+
+def drop_columns(model, *names):
+    """ALTER TABLE ... DROP COLUMN for columns an earlier version added and this one no longer uses"""
+    table = model.__table__
+    existing = {c['name'] for c in inspect(db.engine).get_columns(table.name)}
+    dropped = [name for name in names if name in existing]
+    with db.engine.begin() as conn:
+        for name in dropped:
+            conn.exec_driver_sql(f'ALTER TABLE {table.name} DROP COLUMN {name}')
+    for name in dropped:
+        print(f'✅ Dropped column {table.name}.{name}')
+    return dropped
+
+
+def create_missing_indexes(model):
+    """Create model indexes the table doesn't have yet"""
+    table = model.__table__
+    existing = {i['name'] for i in inspect(db.engine).get_indexes(table.name)}
+    for index in table.indexes:
+        if index.name not in existing:
+            index.create(db.engine)
+            print(f'✅ Created index {index.name}')
+
+
+def backfill_birthday_fields():
+    """Fill friends.birth_month / birth_day / next_birthday in batches"""
+    table = Friend.__table__
+    stmt = update(table).where(table.c.id == bindparam('_id')).values(
+        birth_month=bindparam('birth_month'),
+        birth_day=bindparam('birth_day'),
+        next_birthday=bindparam('next_birthday')
+    )
+    today = date.today()
+    total = 0
+    while True:
+        with db.engine.begin() as conn:
+            rows = conn.execute(
+                select(table.c.id, table.c.birthday)
+                .where(or_(table.c.birth_month.is_(None), table.c.next_birthday.is_(None)))
+                .limit(BATCH_SIZE)
+            ).all()
+            if not rows:
+                break
+            conn.execute(stmt, [
+                {'_id': row.id, **Friend.derived_fields(row.birthday, today)}
+                for row in rows
+            ])
+        total += len(rows)
+    print(f'✅ Backfilled birthday fields for {total} friends')
+
+
+def backfill_user_ids(model):
+    """Copy friends.user_id onto ``model`` rows that don't have it yet, in batches
+
+    Rows whose friend no longer exists have no owner to copy; they are
+    skipped and reported instead of being retried forever.
+    """
+    table = model.__table__
+    friends = Friend.__table__
+    owner = select(friends.c.user_id).where(friends.c.id == table.c.friend_id).scalar_subquery()
+    pending = select(table.c.id).where(
+        table.c.user_id.is_(None), table.c.friend_id.in_(select(friends.c.id).where(friends.c.user_id.is_not(None)))
+    ).limit(BATCH_SIZE).scalar_subquery()
+    total = 0
+    while True:
+        with db.engine.begin() as conn:
+            # Only rows that actually get an owner count, so every batch shrinks ``pending``
+            updated = conn.execute(
+                update(table).where(table.c.id.in_(pending), owner.is_not(None)).values(user_id=owner)
+            ).rowcount
+        if not updated:
+            break
+        total += updated
+    print(f'✅ Backfilled user_id for {total} {table.name}')
+    with db.engine.connect() as conn:
+        orphans = conn.scalar(select(func.count()).select_from(table).where(table.c.user_id.is_(None)))
+    if orphans:
+        print(f'⚠️  {orphans} {table.name} rows still have no user_id (their friend was deleted)')
+
+
+def dedupe_birthday_messages():
+    """Keep the first message per friend and year so the unique index can be built
+    
+    Queued emails of the dropped duplicates are repointed at the kept message.
+    """
+    table = BirthdayMessage.__table__
+    outbox = OutboxEmail.__table__
+    removed = 0
+    with db.engine.begin() as conn:
+        groups = conn.execute(
+            select(table.c.friend_id, table.c.year, func.min(table.c.id).label('keep'))
+            .group_by(table.c.friend_id, table.c.year).having(func.count() > 1)
+        ).all()
+        for group in groups:
+            duplicates = select(table.c.id).where(
+                table.c.friend_id == group.friend_id, table.c.year == group.year, table.c.id != group.keep
+            ).scalar_subquery()
+            conn.execute(
+                update(outbox).where(outbox.c.birthday_message_id.in_(duplicates)).values(birthday_message_id=group.keep)
+            )
+            removed += conn.execute(delete(table).where(table.c.id.in_(duplicates))).rowcount
+    if removed:
+        print(f'✅ Removed {removed} duplicate birthday messages')
+
+
+def upgrade_db():
+    """Bring the schema up to date and backfill derived data"""
+    with app.app_context():
+        db.create_all()
+        add_missing_columns(User)
+        drop_columns(User, 'session_version')
+        add_missing_columns(Friend)
+        add_missing_columns(BirthdayMessage)
+        add_missing_columns(Alert)
+        backfill_birthday_fields()
+        backfill_user_ids(BirthdayMessage)
+        backfill_user_ids(Alert)
+        create_missing_indexes(User)
+        create_missing_indexes(Friend)
+        dedupe_birthday_messages()
+        create_missing_indexes(BirthdayMessage)
+        create_missing_indexes(Alert)
+        print('✅ Database upgrade complete!')
+
+
+if __name__ == '__main__':
+    upgrade_db()
@@ -0,0 +1,96 @@
+"""
+Per-process cache of the users behind logged-in sessions
+Flask-Login loads the session's user on every authenticated request. Users
+are kept here as detached snapshots for USER_CACHE_TTL seconds and merged
+into the request's session without a query. Every ORM change to a user row
+bumps the cluster-wide 'users' cache stamp in the same transaction; each
+worker reads the stamp at most every USER_CACHE_STAMP_SECONDS and drops all
+its snapshots when it has moved.
+users.data_version changes far more often and is never read from a snapshot
+(see cache.current_data_version).
+"""
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import event, insert, inspect, select, update
+
+from app_factory import db, login_manager
+from cache import LRUCache
+from models import User, CacheStamp
+import metrics
+
+USER_STAMP = 'users'
+
+# Columns maintained by bulk updates, which don't invalidate snapshots
+_VOLATILE_COLUMNS = {'data_version'}
+
+_users = None
+_stamp = {'version': None, 'checked_at': float('-inf')}
+_lock = threading.Lock()
+
+
+def _user_cache():
+    """Return the process-wide user cache sized from the app config"""
+    global _users
+    with _lock:
+        if _users is None:
+            _users = LRUCache(current_app.config['USER_CACHE_MAX_ENTRIES'])
+        return _users
+
+
+def _check_stamp(cache):
+    """Clear ``cache`` if another worker changed a user since the last check"""
+    now = time.monotonic()
+    with _lock:
+        if now - _stamp['checked_at'] < current_app.config['USER_CACHE_STAMP_SECONDS']:
+            return
+        _stamp['checked_at'] = now
+    version = db.session.scalar(select(CacheStamp.version).where(CacheStamp.name == USER_STAMP)) or 0
+    metrics.incr('user_cache_stamp_checks')
+    with _lock:
+        changed = _stamp['version'] is not None and version != _stamp['version']
+        _stamp['version'] = version
+    if changed:
+        cache.clear()
+        metrics.incr('user_cache_invalidations')
+
+
+@login_manager.user_loader
+def load_user(user_id):
+    user_id = int(user_id)
+    if not current_app.config['USER_CACHE_ENABLED']:
+        return db.session.get(User, user_id)
+
+    cache = _user_cache()
+    _check_stamp(cache)
+    entry = cache.get(user_id)
+    if entry is not None and entry[0] > time.monotonic():
+        metrics.incr('user_cache_hits')
+        return db.session.merge(entry[1], load=False)
+
+    metrics.incr('user_cache_misses')
+    user = db.session.get(User, user_id)
+    if user is None:
+        return None
+    # Keep a detached copy; the request works on its own instance
+    db.session.expunge(user)
+    cache.set(user_id, (time.monotonic() + current_app.config['USER_CACHE_TTL'], user))
+    return db.session.merge(user, load=False)
+
+
+@event.listens_for(User, 'before_update')
+def _invalidate_snapshots(mapper, connection, target):
+    """Bump the users stamp when a password, is_active or other column changes"""
+    state = inspect(target)
+    if not any(state.attrs[column.key].history.has_changes()
+               for column in mapper.column_attrs if column.key not in _VOLATILE_COLUMNS):
+        return
+    stamps = CacheStamp.__table__
+    bumped = connection.execute(
+        update(stamps).where(stamps.c.name == USER_STAMP).values(version=stamps.c.version + 1)
+    ).rowcount
+    if not bumped:
+        connection.execute(insert(stamps).values(name=USER_STAMP, version=1))
+    if _users is not None:
+        _users.discard(target.id)
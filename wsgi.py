@@ -3,10 +3,33 @@ Main application entry point
 """
 from app_factory import create_app
 import os
+import sys
+
+
+def patch_psycopg_for_gevent():
+    """Make psycopg2 cooperative when running in a gevent-patched worker
+
+    Otherwise a slow query blocks every other request and alert stream the
+    worker serves. Done here rather than in gunicorn_config.py so it also
+    applies to launchers that don't load that file (Procfile, render.yaml).
+    """
+    if 'gevent.monkey' not in sys.modules:
+        return
+    from gevent import monkey
+    if monkey.is_module_patched('socket'):
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
 
 # Get configuration from environment
 config_name = os.getenv('FLASK_ENV', 'development')
-app = create_app(config_name)
+
+# Spawned helpers (the password-hashing pool) re-import this script as
+# __mp_main__ under `python wsgi.py`; they must not boot a second app,
+# scheduler and outbox dispatcher
+if __name__ != '__mp_main__':
+    patch_psycopg_for_gevent()
+    app = create_app(config_name)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)